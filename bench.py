@@ -0,0 +1,430 @@
+"""Offline benchmark for the booking flow.
+
+Replays synthetic users through the real handlers and ConversationHandler,
+with an in-memory Calendar service and Telegram transport, so it needs no
+network or credentials:
+
+  python bench.py --users 200 --calendar-latency 0.08 --error-rate 0.01
+  python bench.py --users 200 --workshops 4
+
+`python bench.py --startup` instead times a cold `import main` and lists any
+Google client or webhook server modules that were loaded eagerly.
+"""
+import argparse
+import asyncio
+import contextlib
+import copy
+import itertools
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from datetime import date, datetime, timedelta, timezone
+
+import httplib2
+from googleapiclient.errors import HttpError
+from telegram import Update
+from telegram.ext import Application
+from telegram.request import BaseRequest
+
+import main
+from calendar_gateway import CalendarGateway
+from schedule import Schedule
+from workshops import Workshop
+
+# Modules that must only be loaded once the calendar is first used, or the webhook server started
+LAZY_MODULES = ('googleapiclient.discovery', 'google_auth_oauthlib', 'google.oauth2.credentials', 'httplib2', 'uvicorn')
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Workshop Bot', 'username': 'workshopschedulebot'}
+
+
+class FakeCalendar:
+  """In-memory stand-in for the Calendar `service` object.
+
+  Supports events().list (with paging and sync tokens), insert and delete,
+  plus batch requests. Every call sleeps for `latency` seconds and fails
+  with a 503 at `error_rate`.
+  """
+
+  def __init__(self, latency = 0.05, error_rate = 0.0, seed = 0):
+    self.latency = latency
+    self.error_rate = error_rate
+    self.calls = Counter()
+    self._events = {}
+    self._changes = []
+    self._lock = threading.Lock()
+    self._random = random.Random(seed)
+
+  def events(self):
+    return FakeEvents(self)
+
+  def new_batch_http_request(self, callback = None):
+    return FakeBatch(self, callback)
+
+  def call(self, name, fn, sleep = True):
+    self.calls[name] += 1
+    if sleep:
+      time.sleep(self.latency)
+    with self._lock:
+      if self._random.random() < self.error_rate:
+        raise HttpError(httplib2.Response({'status': 503}), b'{"error": {"code": 503, "message": "Backend Error"}}')
+      return fn()
+
+  def _list(self, syncToken = None, pageToken = None, timeMin = None, timeMax = None, maxResults = 250, **kwargs):
+    if syncToken is not None:
+      changed = dict.fromkeys(self._changes[int(syncToken):])
+      items = [self._events[event_id] for event_id in changed]
+    else:
+      items = [
+        event for event in self._events.values()
+        if event['status'] != 'cancelled'
+        and (timeMax is None or event['start']['dateTime'] < timeMax)
+        and (timeMin is None or event['end']['dateTime'] > timeMin)
+      ]
+      items.sort(key = lambda event: event['start']['dateTime'])
+
+    offset = int(pageToken or 0)
+    result = {'items': copy.deepcopy(items[offset:offset + maxResults])}
+    if offset + maxResults < len(items):
+      result['nextPageToken'] = str(offset + maxResults)
+    else:
+      result['nextSyncToken'] = str(len(self._changes))
+    return result
+
+  def _get(self, eventId):
+    return copy.deepcopy(self._events[eventId])
+
+  def _insert(self, body):
+    if body.get('id') in self._events:
+      raise HttpError(httplib2.Response({'status': 409}), b'{"error": {"code": 409, "message": "The requested identifier already exists."}}')
+    event = copy.deepcopy(body)
+    for edge in ('start', 'end'):
+      # The real API answers with an explicit offset
+      moment = datetime.fromisoformat(event[edge]['dateTime'])
+      if moment.tzinfo is None:
+        event[edge]['dateTime'] = moment.isoformat() + '+08:00'
+    event.setdefault('id', uuid.uuid4().hex)
+    event['status'] = 'confirmed'
+    event['created'] = datetime.now(timezone.utc).isoformat()
+    event['htmlLink'] = f"https://calendar.example/event?eid={event['id']}"
+    self._events[event['id']] = event
+    self._changes.append(event['id'])
+    return copy.deepcopy(event)
+
+  def _delete(self, eventId):
+    self._events[eventId]['status'] = 'cancelled'
+    self._changes.append(eventId)
+    return ''
+
+
+class FakeEvents:
+  def __init__(self, calendar):
+    self._calendar = calendar
+
+  def list(self, calendarId = None, **kwargs):
+    return FakeRequest(self._calendar, 'list', lambda: self._calendar._list(**kwargs))
+
+  def get(self, calendarId = None, eventId = None):
+    return FakeRequest(self._calendar, 'get', lambda: self._calendar._get(eventId))
+
+  def insert(self, calendarId = None, body = None):
+    return FakeRequest(self._calendar, 'insert', lambda: self._calendar._insert(body))
+
+  def delete(self, calendarId = None, eventId = None):
+    return FakeRequest(self._calendar, 'delete', lambda: self._calendar._delete(eventId))
+
+
+class FakeRequest:
+  def __init__(self, calendar, name, fn):
+    self._calendar = calendar
+    self.name = name
+    self._fn = fn
+
+  def execute(self, http = None, sleep = True):
+    return self._calendar.call(self.name, self._fn, sleep = sleep)
+
+
+class FakeBatch:
+  def __init__(self, calendar, callback):
+    self._calendar = calendar
+    self._callback = callback
+    self._requests = []
+
+  def add(self, request, callback = None, request_id = None):
+    self._requests.append((request, callback or self._callback, request_id))
+
+  def execute(self, http = None):
+    # One round trip for the whole batch
+    self._calendar.calls['batch'] += 1
+    time.sleep(self._calendar.latency)
+    for request, callback, request_id in self._requests:
+      try:
+        response, exception = request.execute(sleep = False), None
+      except HttpError as error:
+        response, exception = None, error
+      callback(request_id, response, exception)
+
+
+class FakeTelegram(BaseRequest):
+  """Bot API transport that answers every call locally and remembers the last keyboard per chat."""
+
+  def __init__(self, latency = 0.0):
+    self.latency = latency
+    self.calls = Counter()
+    self.keyboards = {}
+    self.texts = {}
+    self._message_ids = itertools.count(1000)
+
+  async def initialize(self):
+    pass
+
+  async def shutdown(self):
+    pass
+
+  async def do_request(self, url, method, request_data = None, read_timeout = None, write_timeout = None,
+                       connect_timeout = None, pool_timeout = None):
+    endpoint = url.rsplit('/', 1)[-1]
+    self.calls[endpoint] += 1
+    if self.latency:
+      await asyncio.sleep(self.latency)
+
+    parameters = request_data.parameters if request_data else {}
+    if endpoint == 'getMe':
+      result = BOT_USER
+    elif endpoint in ('sendMessage', 'editMessageText'):
+      result = self._message(endpoint, parameters)
+    else:
+      result = True
+    return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+  def _message(self, endpoint, parameters):
+    chat_id = int(parameters['chat_id'])
+    message_id = int(parameters['message_id']) if endpoint == 'editMessageText' else next(self._message_ids)
+    message = {
+      'message_id': message_id,
+      'date': int(time.time()),
+      'chat': {'id': chat_id, 'type': 'private'},
+      'from': BOT_USER,
+      'text': parameters['text'],
+    }
+    markup = parameters.get('reply_markup')
+    if isinstance(markup, str):
+      markup = json.loads(markup)
+    if markup:
+      message['reply_markup'] = markup
+      self.keyboards[chat_id] = message
+    elif chat_id in self.keyboards and self.keyboards[chat_id]['message_id'] == message_id:
+      # Editing a message without a markup removes its keyboard
+      del self.keyboards[chat_id]
+    self.texts[chat_id] = parameters['text']
+    return message
+
+
+class SyntheticUser:
+  """Walks one user through /bookslot, choosing from whatever keyboards the bot sends."""
+
+  update_ids = itertools.count(1)
+
+  def __init__(self, bench, user_id, day):
+    self.bench = bench
+    self.user_id = user_id
+    self.day = day
+    self.user = {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}'}
+    self.chat = {'id': user_id, 'type': 'private'}
+    self.message_ids = itertools.count(1)
+
+  async def book(self):
+    await self.send('bookslot', '/bookslot', command = True)
+    if len(main.workshops) > 1 and not await self.click('handle_workshop'):
+      return False
+    await self.send('handle_date', self.day.strftime('%d%m%y'))
+    for step in ('handle_time_start', 'handle_time_end', 'handle_location'):
+      if not await self.click(step):
+        return False
+    await self.send('handle_name', f'3SG User {self.user_id}')
+    await self.send('handle_course', self.bench.random.choice(['BSC', 'ISC', 'Works']))
+    return await self.click('confirmbooking', 'YES')
+
+  async def send(self, step, text, command = False):
+    message = {
+      'message_id': next(self.message_ids),
+      'date': int(time.time()),
+      'chat': self.chat,
+      'from': self.user,
+      'text': text,
+    }
+    if command:
+      message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    await self.bench.process(step, {'update_id': next(self.update_ids), 'message': message})
+
+  async def click(self, step, data = None):
+    keyboard = self.bench.telegram.keyboards.get(self.user_id)
+    if keyboard is None:
+      return False
+    buttons = [button for row in keyboard['reply_markup']['inline_keyboard'] for button in row]
+    if data is None:
+      data = self.bench.random.choice(buttons)['callback_data']
+    callback_query = {
+      'id': str(uuid.uuid4()),
+      'from': self.user,
+      'chat_instance': str(self.user_id),
+      'data': data,
+      'message': keyboard,
+    }
+    await self.bench.process(step, {'update_id': next(self.update_ids), 'callback_query': callback_query})
+    return True
+
+
+class Bench:
+  def __init__(self, args):
+    self.args = args
+    self.random = random.Random(args.seed)
+    # One fake calendar per workshop, like separate Google calendars
+    self.calendars = [FakeCalendar(args.calendar_latency, args.error_rate, args.seed + i) for i in range(args.workshops)]
+    self.telegram = FakeTelegram(args.telegram_latency)
+    self.latencies = defaultdict(list)
+    self.resolved = 0
+
+    # Point the bot at workshops backed by the fake services
+    main.BookingMode = args.booking_mode
+    self.queue_dir = tempfile.TemporaryDirectory()
+    main.workshops = {}
+    schedule = Schedule.from_grid(main.start_times, main.end_times, main.locations)
+    for i, calendar in enumerate(self.calendars, 1):
+      workshop = Workshop(f'bench{i}', f'Workshop {i}', f'bench{i}', schedule,
+                          CalendarGateway(lambda calendar = calendar: calendar, f'bench{i}'),
+                          os.path.join(self.queue_dir.name, f'bookings-{i}.sqlite3'))
+      workshop.booking_queue.flush_interval = 0.1
+      main.workshops[workshop.id] = workshop
+
+    self.application = (
+      Application.builder()
+      .token('123456:BENCH')
+      .request(self.telegram)
+      .get_updates_request(FakeTelegram())
+      .concurrent_updates(args.concurrent_updates)
+      .build()
+    )
+    main.add_handlers(self.application)
+
+  async def process(self, step, data):
+    update = Update.de_json(data, self.application.bot)
+    started = time.perf_counter()
+    # Same concurrency limit as updates fetched by the Updater
+    await self.application.update_processor.process_update(update, self.application.process_update(update))
+    self.latencies[step].append(time.perf_counter() - started)
+
+  async def run(self):
+    first_day = date.today() + timedelta(days = 1)
+    users = [
+      SyntheticUser(self, user_id, first_day + timedelta(days = self.random.randrange(self.args.days)))
+      for user_id in range(1, self.args.users + 1)
+    ]
+
+    async with self.application:
+      workers = []
+      for workshop in main.workshops.values():
+        workshop.booking_queue.open(
+          lambda booking, status, event, workshop = workshop: self.booking_resolved(workshop, booking, status, event))
+        workers.append(asyncio.create_task(workshop.booking_queue.run()))
+      started = time.perf_counter()
+      await asyncio.gather(*(user.book() for user in users))
+      # Queued bookings only count once the workers have written them to the calendars
+      while self.resolved < enqueued_count() or any(
+          workshop.booking_queue.pending_count() for workshop in main.workshops.values()):
+        await asyncio.sleep(0.01)
+      elapsed = time.perf_counter() - started
+      for worker in workers:
+        worker.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+          await worker
+    for workshop in main.workshops.values():
+      workshop.booking_queue.close()
+      workshop.gateway.shutdown()
+    self.queue_dir.cleanup()
+    confirmed = sum('confirmed' in self.telegram.texts.get(user.user_id, '') for user in users)
+    return confirmed, elapsed
+
+  async def booking_resolved(self, workshop, booking, status, event):
+    await main.booking_resolved(self.application.bot, workshop, booking, status, event)
+    self.resolved += 1
+
+  def report(self, confirmed, elapsed):
+    updates = sum(len(samples) for samples in self.latencies.values())
+    calendar_totals = sum((calendar.calls for calendar in self.calendars), Counter())
+    calendar_calls = sum(calendar_totals.values())
+    telegram_calls = sum(count for endpoint, count in self.telegram.calls.items() if endpoint != 'getMe')
+
+    print(f'Bookings: {confirmed} confirmed of {self.args.users} users in {elapsed:.2f} s '
+          f'({confirmed / elapsed:.1f} bookings/s, {updates / elapsed:.1f} updates/s)')
+    print(f'Calendar calls: {calendar_calls} ({calendar_calls / max(confirmed, 1):.2f} per confirmed booking) '
+          + ', '.join(f'{name}={count}' for name, count in sorted(calendar_totals.items())))
+    print(f'Telegram calls: {telegram_calls} ({telegram_calls / max(confirmed, 1):.2f} per confirmed booking) '
+          + ', '.join(f'{name}={count}' for name, count in sorted(self.telegram.calls.items()) if name != 'getMe'))
+    print()
+    print(f"{'Handler':<20}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}")
+    for step, samples in self.latencies.items():
+      print(f'{step:<20}{len(samples):>8}{percentile(samples, 0.5) * 1000:>10.1f}{percentile(samples, 0.99) * 1000:>10.1f}')
+
+
+def enqueued_count():
+  counters = main.metrics.snapshot()['counters']
+  return sum(counter['value'] for counter in counters if counter['name'] == 'booking_queue_enqueued_total')
+
+
+def measure_startup(runs):
+  # Fresh interpreter per run, so nothing is already imported
+  script = (
+    'import sys, time\n'
+    'started = time.perf_counter()\n'
+    'import main\n'
+    'print(time.perf_counter() - started)\n'
+    f'print(",".join(name for name in {LAZY_MODULES!r} if name in sys.modules))\n'
+  )
+  timings = []
+  for _ in range(runs):
+    output = subprocess.run([sys.executable, '-c', script], capture_output = True, text = True, check = True,
+                            cwd = os.path.dirname(os.path.abspath(__file__))).stdout.splitlines()
+    timings.append(float(output[0]))
+    eager = output[1] if len(output) > 1 else ''
+  print(f'import main: median {statistics.median(timings) * 1000:.0f} ms, min {min(timings) * 1000:.0f} ms over {runs} runs')
+  print(f"Lazy modules loaded at import: {eager or 'none'}")
+
+
+def percentile(samples, fraction):
+  ordered = sorted(samples)
+  return ordered[round(fraction * (len(ordered) - 1))]
+
+
+def parse_args():
+  parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+  parser.add_argument('--users', type = int, default = 50, help = 'synthetic users booking at once')
+  parser.add_argument('--days', type = int, default = 5, help = 'spread bookings over this many days')
+  parser.add_argument('--calendar-latency', type = float, default = 0.05, help = 'seconds per Calendar call')
+  parser.add_argument('--error-rate', type = float, default = 0.0, help = 'fraction of Calendar calls that fail')
+  parser.add_argument('--telegram-latency', type = float, default = 0.0, help = 'seconds per Bot API call')
+  parser.add_argument('--concurrent-updates', type = int, default = 1, help = 'updates the Application handles at once')
+  parser.add_argument('--workshops', type = int, default = 1, help = 'workshops (separate calendars) users choose from')
+  parser.add_argument('--booking-mode', choices = ['queued', 'direct'], default = 'queued',
+                      help = 'write bookings through the queue worker or straight to the calendar')
+  parser.add_argument('--seed', type = int, default = 0)
+  parser.add_argument('--startup', type = int, nargs = '?', const = 5, metavar = 'RUNS',
+                      help = 'time a cold import of main.py instead of running the booking benchmark')
+  return parser.parse_args()
+
+
+if __name__ == '__main__':
+  args = parse_args()
+  if args.startup:
+    measure_startup(args.startup)
+    sys.exit()
+  bench = Bench(args)
+  confirmed, elapsed = asyncio.run(bench.run())
+  bench.report(confirmed, elapsed)
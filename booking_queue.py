@@ -0,0 +1,203 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+from googleapiclient.errors import HttpError
+
+from governor import CalendarUnavailable, is_retryable
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# How often the worker retries pending bookings when nothing new arrives (seconds)
+FLUSH_INTERVAL = 15
+# Bookings written per batch
+FLUSH_BATCH_SIZE = 50
+# Flushes a booking may fail with retryable errors before it is given up
+MAX_FLUSH_ATTEMPTS = 20
+
+COLUMNS = ('id', 'chat_id', 'day', 'location', 'starting_period', 'ending_period', 'name', 'course', 'body')
+
+
+class BookingQueue:
+  """Durable write-behind queue of bookings waiting to go into the calendar.
+
+  confirmbooking appends a booking to an SQLite log and answers straight
+  away; the slot is held in the SlotIndex so nobody else can take it. A
+  background worker writes pending bookings to the calendar in batches,
+  resolves conflicts and reports each final result through `on_result`.
+  Bookings stay pending through Calendar outages and across restarts.
+
+  Every write waits for the disk, so writes go through their own connection
+  on one writer thread and never block the event loop. Reads use the loop's
+  connection; in WAL mode they see each committed write.
+  """
+
+  def __init__(self, path, slot_index, reservations, flush_interval = FLUSH_INTERVAL):
+    self.path = path
+    self._slot_index = slot_index
+    self._reservations = reservations
+    self.flush_interval = flush_interval
+    self._connection = None
+    self._writer = None
+    self._write_executor = None
+    self._on_result = None
+    self._wake = None
+
+  def open(self, on_result):
+    """Open the log and hold the slots of bookings left pending by the last run.
+
+    `on_result(booking, status, event)` is awaited once per booking with status
+    'booked', 'conflict' or 'failed'.
+    """
+    self._on_result = on_result
+    self._wake = asyncio.Event()
+    self._connection = sqlite3.connect(self.path)
+    self._connection.row_factory = sqlite3.Row
+    self._connection.execute('PRAGMA journal_mode = WAL')
+    # A reservation the user has been told about must survive a power cut
+    self._connection.execute('PRAGMA synchronous = FULL')
+    self._connection.execute(
+      'CREATE TABLE IF NOT EXISTS bookings ('
+      'id TEXT PRIMARY KEY, chat_id INTEGER NOT NULL, day TEXT NOT NULL, location INTEGER NOT NULL, '
+      'starting_period INTEGER NOT NULL, ending_period INTEGER NOT NULL, name TEXT, course TEXT, '
+      'body TEXT NOT NULL, status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, created REAL NOT NULL)'
+    )
+    self._connection.execute('CREATE INDEX IF NOT EXISTS bookings_status ON bookings (status, created)')
+    self._connection.commit()
+    # Only ever used from the one writer thread
+    self._writer = sqlite3.connect(self.path, check_same_thread = False)
+    self._writer.execute('PRAGMA synchronous = FULL')
+    self._write_executor = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'booking-queue')
+
+    for booking in self._pending():
+      self._hold(booking)
+
+  def close(self):
+    if self._write_executor is not None:
+      # Lets a write already under way reach the disk
+      self._write_executor.shutdown(wait = True)
+      self._write_executor = None
+    if self._writer is not None:
+      self._writer.close()
+      self._writer = None
+    if self._connection is not None:
+      self._connection.close()
+      self._connection = None
+
+  async def enqueue(self, booking):
+    """Hold a booking's slot and durably record it. Returns once it is on disk."""
+    # Held before the write, so nobody can take the slot while it is waiting for the disk
+    self._hold(booking)
+    try:
+      await self._write(
+        'INSERT INTO bookings (id, chat_id, day, location, starting_period, ending_period, name, course, body, status, created) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, \'pending\', ?)',
+        (booking['id'], booking['chat_id'], booking['day'].isoformat(), booking['location'], booking['starting_period'],
+         booking['ending_period'], booking['name'], booking['course'], json.dumps(booking['body']), time.time()),
+      )
+    except BaseException:
+      self._slot_index.release(booking['id'])
+      raise
+    metrics.increment('booking_queue_enqueued_total')
+    self._wake.set()
+
+  async def _write(self, sql, parameters):
+    """Run one statement and commit it on the writer thread."""
+    def write():
+      with self._writer:
+        self._writer.execute(sql, parameters)
+    await asyncio.get_running_loop().run_in_executor(self._write_executor, write)
+
+  def pending_count(self):
+    (count,) = self._connection.execute("SELECT COUNT(*) FROM bookings WHERE status = 'pending'").fetchone()
+    return count
+
+  async def run(self):
+    """Worker loop: flush whenever a booking arrives, and retry pending ones every flush_interval."""
+    while True:
+      # asyncio.wait rather than wait_for, which can swallow a cancel that races with the wake-up
+      waiter = asyncio.ensure_future(self._wake.wait())
+      try:
+        await asyncio.wait([waiter], timeout = self.flush_interval)
+      finally:
+        waiter.cancel()
+      self._wake.clear()
+      try:
+        while await self.flush():
+          pass
+      except (HttpError, CalendarUnavailable) as error:
+        # Leave everything pending and try again on the next round
+        logger.warning('Could not flush booking queue: %s', error)
+      except Exception:
+        logger.exception('Booking queue flush failed.')
+
+  async def flush(self):
+    """Write one batch of pending bookings to the calendar. Returns how many were resolved."""
+    bookings = self._pending(FLUSH_BATCH_SIZE)
+    if not bookings:
+      return 0
+
+    # The stored periods and location index belong to the grid the booking was queued on;
+    # check it where its times and location name fall on the current one
+    resolved = 0
+    writable = []
+    for booking in bookings:
+      slot = self._slot_index.booking_slot(booking['body'])
+      if slot is None:
+        logger.error('Booking %s no longer fits the schedule.', booking['id'])
+        await self._resolve(booking, 'failed')
+        resolved += 1
+      else:
+        writable.append((booking, slot))
+    if not writable:
+      return resolved
+
+    # Our own holds do not count as conflicts
+    outcomes = await self._reservations.book([(*slot, booking['body']) for booking, slot in writable], include_holds = False)
+    for (booking, _), (outcome, result) in zip(writable, outcomes):
+      if outcome == 'failed' and is_retryable(result) and booking['attempts'] + 1 < MAX_FLUSH_ATTEMPTS:
+        logger.warning('Booking %s will be retried: %s', booking['id'], result)
+        await self._write('UPDATE bookings SET attempts = attempts + 1 WHERE id = ?', (booking['id'],))
+        continue
+      if outcome == 'unverified' and booking['attempts'] + 1 < MAX_FLUSH_ATTEMPTS:
+        # The event is in the calendar; the next flush finds it by its ID and only re-verifies it
+        logger.warning('Booking %s is in the calendar but not yet verified.', booking['id'])
+        await self._write('UPDATE bookings SET attempts = attempts + 1 WHERE id = ?', (booking['id'],))
+        continue
+      if outcome in ('booked', 'unverified'):
+        await self._resolve(booking, 'booked', result)
+      elif outcome == 'failed':
+        logger.error('Booking %s failed: %s', booking['id'], result)
+        await self._resolve(booking, 'failed')
+      else:
+        await self._resolve(booking, 'conflict')
+      resolved += 1
+    return resolved
+
+  async def _resolve(self, booking, status, event = None):
+    await self._write('UPDATE bookings SET status = ? WHERE id = ?', (status, booking['id']))
+    self._slot_index.release(booking['id'])
+    metrics.increment('booking_queue_results_total', status = status)
+    try:
+      await self._on_result(booking, status, event)
+    except Exception:
+      logger.exception('Could not report result of booking %s.', booking['id'])
+
+  def _hold(self, booking):
+    self._slot_index.hold(booking['id'], booking['body'])
+
+  def _pending(self, limit = -1):
+    rows = self._connection.execute(
+      f"SELECT {', '.join(COLUMNS)}, attempts FROM bookings WHERE status = 'pending' ORDER BY created LIMIT ?", (limit,))
+    bookings = []
+    for row in rows:
+      booking = dict(row)
+      booking['day'] = date.fromisoformat(booking['day'])
+      booking['body'] = json.loads(booking['body'])
+      bookings.append(booking)
+    return bookings
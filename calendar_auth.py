@@ -0,0 +1,90 @@
+import logging
+import os
+import tempfile
+import threading
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+TOKEN_FILE = 'token.json'
+CLIENT_SECRETS_FILE = 'credentials.json'
+
+# Refresh the access token this long before Google expires it
+REFRESH_MARGIN = timedelta(minutes = 5)
+
+
+class CredentialManager:
+  """Process-wide holder of the Calendar OAuth credentials.
+
+  token.json is read once. The same Credentials object is refreshed in place
+  ahead of expiry and written back atomically, so every request shares it.
+  The google-auth modules are imported on first use to keep bot startup fast.
+  """
+
+  def __init__(self, scopes, token_file = TOKEN_FILE, client_secrets_file = CLIENT_SECRETS_FILE,
+               refresh_margin = REFRESH_MARGIN):
+    self.scopes = scopes
+    self.token_file = token_file
+    self.client_secrets_file = client_secrets_file
+    self.refresh_margin = refresh_margin
+    self._creds = None
+    self._lock = threading.Lock()
+
+  def get(self):
+    """Return valid credentials, loading or refreshing them if needed (blocking)."""
+    with self._lock:
+      if self._creds is None:
+        self._creds = self._load()
+      if self._refresh_due():
+        self._refresh()
+      return self._creds
+
+  def refresh_if_due(self):
+    """Refresh the token if it expires within the refresh margin (blocking)."""
+    self.get()
+
+  def _load(self):
+    from google.oauth2.credentials import Credentials
+    from google_auth_oauthlib.flow import InstalledAppFlow
+
+    creds = None
+    if os.path.exists(self.token_file):
+      creds = Credentials.from_authorized_user_file(self.token_file)
+
+    if not creds or (not creds.valid and not creds.refresh_token):
+      flow = InstalledAppFlow.from_client_secrets_file(self.client_secrets_file, self.scopes)
+      creds = flow.run_local_server(port = 0)
+      self._save(creds)
+
+    return creds
+
+  def _refresh_due(self):
+    creds = self._creds
+    if not creds.valid:
+      return True
+    if creds.expiry is None:
+      return False
+    # google-auth keeps expiry as a naive UTC datetime
+    now = datetime.now(timezone.utc).replace(tzinfo = None)
+    return creds.expiry - now < self.refresh_margin
+
+  def _refresh(self):
+    from google.auth.transport.requests import Request
+
+    self._creds.refresh(Request())
+    self._save(self._creds)
+    logger.info('Calendar credentials refreshed.')
+
+  def _save(self, creds):
+    # Write to a temporary file in the same directory and swap it in, so a crash never leaves a half-written token
+    directory = os.path.dirname(os.path.abspath(self.token_file))
+    fd, tmp_path = tempfile.mkstemp(dir = directory, prefix = '.token-', suffix = '.json')
+    try:
+      with os.fdopen(fd, 'w') as token:
+        token.write(creds.to_json())
+        token.flush()
+        os.fsync(token.fileno())
+      os.replace(tmp_path, self.token_file)
+    except BaseException:
+      os.unlink(tmp_path)
+      raise
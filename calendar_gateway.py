@@ -0,0 +1,184 @@
+import asyncio
+import contextlib
+import functools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from googleapiclient.errors import HttpError
+
+from governor import RequestGovernor, backoff_delay, is_retryable
+from metrics import metrics
+
+# Maximum number of Google Calendar requests in flight at once
+CALENDAR_WORKERS = int(os.getenv('CalendarWorkers', '4'))
+
+# Google accepts at most 50 calls in one batch HTTP request
+BATCH_SIZE = 50
+
+
+class CalendarGateway:
+  """Async front for the Google Calendar API.
+
+  The google-api-python-client is blocking, so every call is run on a bounded
+  thread pool instead of on the bot's event loop. The Calendar service is built
+  once and shared; httplib2 connections are not thread-safe, so each worker
+  thread keeps its own pooled HTTP client from `http_factory`. Every request
+  goes through a RequestGovernor for rate limiting, retries and the circuit
+  breaker.
+  """
+
+  def __init__(self, service_factory, calendar_id, http_factory = None, max_workers = CALENDAR_WORKERS, governor = None):
+    self._service_factory = service_factory
+    self._http_factory = http_factory
+    self.calendar_id = calendar_id
+    self.governor = governor or RequestGovernor()
+    self._service = None
+    self._service_lock = threading.Lock()
+    self._local = threading.local()
+    self._executor = ThreadPoolExecutor(max_workers = max_workers, thread_name_prefix = 'calendar')
+
+  @property
+  def service(self):
+    """The shared Calendar service, built on first use (blocking)."""
+    if self._service is None:
+      with self._service_lock:
+        if self._service is None:
+          self._service = self._service_factory()
+    return self._service
+
+  def _http(self):
+    http = getattr(self._local, 'http', None)
+    if http is None:
+      http = self._local.http = self._http_factory()
+    return http
+
+  def execute(self, request, method):
+    """Execute a prepared API request on this thread's HTTP client (blocking)."""
+    with self._record(method):
+      if self._http_factory is None:
+        return request.execute()
+      return request.execute(http = self._http())
+
+  @contextlib.contextmanager
+  def _record(self, method):
+    # Count and time every round trip to Google, labelled with the HTTP status
+    started = time.perf_counter()
+    status = '200'
+    try:
+      yield
+    except Exception as error:
+      resp = getattr(error, 'resp', None)
+      status = str(resp.status) if resp is not None else type(error).__name__
+      raise
+    finally:
+      metrics.increment('calendar_calls_total', method = method, status = status)
+      metrics.observe('calendar_latency_seconds', time.perf_counter() - started, method = method)
+
+  async def run(self, fn, *args, **kwargs):
+    """Run a blocking callable on the calendar thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+  async def request(self, method, make_request, cost = 1):
+    """Send one API request through the governor. `make_request(events)` builds it from the events resource."""
+    def call():
+      return self.execute(make_request(self.service.events()), method)
+
+    return await self.governor.call(lambda: self.run(call), cost = cost)
+
+  async def list_events(self, **kwargs):
+    return await self.request('list', lambda events: events.list(calendarId = self.calendar_id, **kwargs))
+
+  async def get_event(self, event_id):
+    return await self.request('get', lambda events: events.get(calendarId = self.calendar_id, eventId = event_id))
+
+  async def insert_event(self, body):
+    try:
+      return await self.request('insert', lambda events: events.insert(calendarId = self.calendar_id, body = body))
+    except HttpError as error:
+      # Bodies carry their own ID, so a retry of an insert that did go through answers 409
+      if error.resp.status == 409 and 'id' in body:
+        return await self.get_event(body['id'])
+      raise
+
+  async def delete_event(self, event_id):
+    try:
+      return await self.request('delete', lambda events: events.delete(calendarId = self.calendar_id, eventId = event_id))
+    except HttpError as error:
+      # Already deleted, e.g. by a retried attempt
+      if error.resp.status != 410:
+        raise
+
+  def execute_batch(self, requests):
+    """Send prepared requests as batch HTTP requests (blocking).
+
+    Returns one (response, error) pair per request, in order.
+    """
+    results = [None] * len(requests)
+
+    def callback(request_id, response, exception):
+      results[int(request_id)] = (response, exception)
+
+    for offset in range(0, len(requests), BATCH_SIZE):
+      batch = self.service.new_batch_http_request(callback = callback)
+      for index in range(offset, min(offset + BATCH_SIZE, len(requests))):
+        batch.add(requests[index], request_id = str(index))
+      with self._record('batch'):
+        if self._http_factory is None:
+          batch.execute()
+        else:
+          batch.execute(http = self._http())
+
+    for response, error in results:
+      if error is not None:
+        metrics.increment('calendar_batch_errors_total', status = str(getattr(getattr(error, 'resp', None), 'status', 'error')))
+    return results
+
+  async def _batch_with_retries(self, make_request, items):
+    """Send `make_request(events, item)` for every item as batch requests, retrying only the calls that hit retryable errors."""
+    results = [None] * len(items)
+    pending = list(range(len(items)))
+
+    for attempt in range(self.governor.max_attempts):
+      def call(indices = pending):
+        events = self.service.events()
+        return self.execute_batch([make_request(events, items[index]) for index in indices])
+
+      responses = await self.governor.call(lambda: self.run(call), cost = len(pending))
+      retry = []
+      for index, (response, error) in zip(pending, responses):
+        results[index] = (response, error)
+        if error is not None and is_retryable(error):
+          retry.append(index)
+      if not retry:
+        break
+      pending = retry
+      await asyncio.sleep(backoff_delay(attempt))
+    return results
+
+  async def insert_events_batch(self, bodies):
+    """Insert events with batch requests. Returns one (event, error) pair per body."""
+    results = await self._batch_with_retries(
+      lambda events, body: events.insert(calendarId = self.calendar_id, body = body), bodies)
+
+    # A 409 means an earlier attempt of that insert went through
+    for index, (response, error) in enumerate(results):
+      if isinstance(error, HttpError) and error.resp.status == 409 and 'id' in bodies[index]:
+        results[index] = (await self.get_event(bodies[index]['id']), None)
+    return results
+
+  async def delete_events_batch(self, event_ids):
+    """Delete events with batch requests. Returns one error (or None) per ID."""
+    results = await self._batch_with_retries(
+      lambda events, event_id: events.delete(calendarId = self.calendar_id, eventId = event_id), event_ids)
+
+    # 410 Gone: already deleted, e.g. by a retried attempt
+    return [
+      None if isinstance(error, HttpError) and error.resp.status == 410 else error
+      for _, error in results
+    ]
+
+  def shutdown(self):
+    self._executor.shutdown(wait = False, cancel_futures = True)
@@ -0,0 +1,163 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+from googleapiclient.errors import HttpError
+
+# Calendar events are booked in Singapore time (UTC+8)
+SGT = timezone(timedelta(hours = 8))
+
+# Oldest the cache may be before a read forces a sync (seconds)
+CACHE_MAX_STALENESS = float(os.getenv('CacheMaxStaleness', '60'))
+
+# Events per page requested from events().list
+PAGE_SIZE = 2500
+
+
+def event_span(event):
+  """Return an event's (start, end) as aware datetimes. All-day events span whole days."""
+  start = event.get('start', {})
+  end = event.get('end', {})
+  if 'dateTime' in start:
+    # Bodies we build carry local times with a separate timeZone of Asia/Singapore; events from the API carry an offset
+    return tuple(
+      moment if moment.tzinfo else moment.replace(tzinfo = SGT)
+      for moment in (datetime.fromisoformat(start['dateTime']), datetime.fromisoformat(end['dateTime']))
+    )
+  start_date = datetime.fromisoformat(start['date']).replace(tzinfo = SGT)
+  end_date = datetime.fromisoformat(end['date']).replace(tzinfo = SGT)
+  return start_date, end_date
+
+
+class EventCache:
+  """In-process copy of the calendar kept fresh with incremental sync tokens.
+
+  The first sync lists the whole calendar and keeps the `nextSyncToken`; later
+  syncs only fetch what changed since. Events are indexed by local date so
+  reads for a day or a range never touch the network.
+  """
+
+  def __init__(self, gateway, max_staleness = CACHE_MAX_STALENESS):
+    self._gateway = gateway
+    self.max_staleness = max_staleness
+    self._events = {}
+    self._spans = {}
+    self._by_date = {}
+    self._sync_token = None
+    self._synced_at = None
+    self._lock = asyncio.Lock()
+    self._listeners = []
+
+  def subscribe(self, listener):
+    """Register an index to be told about every added, removed or cleared event.
+
+    Listeners implement `event_added(event, start, end)`, `event_removed(event_id)`
+    and `cleared()`.
+    """
+    self._listeners.append(listener)
+    self.replay(listener)
+
+  def replay(self, listener):
+    """Tell a listener about every cached event again, e.g. after it was reset."""
+    for event_id, event in self._events.items():
+      listener.event_added(event, *self._spans[event_id])
+
+  @property
+  def is_stale(self):
+    return self._synced_at is None or time.monotonic() - self._synced_at > self.max_staleness
+
+  async def ensure_fresh(self):
+    """Sync only if the cache is older than the staleness bound."""
+    if self.is_stale:
+      await self.refresh()
+
+  async def refresh(self):
+    """Force a sync with the calendar, e.g. before a write."""
+    async with self._lock:
+      try:
+        await self._sync()
+      except HttpError as error:
+        # 410 Gone: the sync token has expired and a full sync is needed
+        if error.resp.status != 410:
+          raise
+        self._sync_token = None
+        await self._sync()
+
+  async def _sync(self):
+    full_sync = self._sync_token is None
+    params = {'singleEvents': True, 'maxResults': PAGE_SIZE, 'timeZone': 'Asia/Singapore'}
+    if not full_sync:
+      params['syncToken'] = self._sync_token
+
+    changed = []
+    page_token = None
+    while True:
+      result = await self._gateway.list_events(pageToken = page_token, **params)
+      changed.extend(result.get('items', []))
+      page_token = result.get('nextPageToken')
+      if not page_token:
+        break
+
+    if full_sync:
+      self._events.clear()
+      self._spans.clear()
+      self._by_date.clear()
+      for listener in self._listeners:
+        listener.cleared()
+    for event in changed:
+      if event.get('status') == 'cancelled':
+        self.remove(event['id'])
+      else:
+        self.add(event)
+
+    self._sync_token = result.get('nextSyncToken')
+    self._synced_at = time.monotonic()
+
+  def add(self, event):
+    """Insert or replace an event, e.g. straight after events().insert."""
+    self.remove(event['id'])
+    start, end = event_span(event)
+    self._events[event['id']] = event
+    self._spans[event['id']] = (start, end)
+    for day in self._days(start, end):
+      self._by_date.setdefault(day, set()).add(event['id'])
+    for listener in self._listeners:
+      listener.event_added(event, start, end)
+
+  def remove(self, event_id):
+    if event_id not in self._events:
+      return
+    del self._events[event_id]
+    start, end = self._spans.pop(event_id)
+    for day in self._days(start, end):
+      ids = self._by_date.get(day)
+      if ids is not None:
+        ids.discard(event_id)
+        if not ids:
+          del self._by_date[day]
+    for listener in self._listeners:
+      listener.event_removed(event_id)
+
+  def get(self, event_id):
+    return self._events.get(event_id)
+
+  def events_between(self, time_min, time_max):
+    """Return cached events overlapping [time_min, time_max), ordered by start time and location."""
+    found = set()
+    for day in self._days(time_min, time_max):
+      for event_id in self._by_date.get(day, ()):
+        start, end = self._spans[event_id]
+        if start < time_max and end > time_min:
+          found.add(event_id)
+    return sorted((self._events[event_id] for event_id in found),
+                  key = lambda event: (self._spans[event['id']][0], event.get('location', '')))
+
+  @staticmethod
+  def _days(start, end):
+    # Local dates touched by [start, end)
+    day = start.astimezone(SGT).date()
+    last = (end - timedelta(microseconds = 1)).astimezone(SGT).date() if end > start else day
+    while day <= last:
+      yield day
+      day += timedelta(days = 1)
@@ -0,0 +1,157 @@
+import csv
+import io
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from event_cache import SGT, event_span
+from user_index import booking_owner
+
+# Events requested per events().list page while exporting
+EXPORT_PAGE_SIZE = 1000
+# Exports larger than this are spooled to disk instead of memory (bytes)
+SPOOL_SIZE = 1024 * 1024
+# Least time between progress updates (seconds)
+PROGRESS_INTERVAL = 2.0
+
+CSV_COLUMNS = ['workshop', 'date', 'start', 'end', 'location', 'description', 'telegram_user_id', 'event_id', 'created']
+# Spreadsheets run cells starting with these as formulas
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+class CsvWriter:
+  """CSV rows, one per event. The bookers' Telegram IDs are only written with `include_owners`."""
+
+  def __init__(self, out, include_owners = False):
+    self._writer = csv.writer(out)
+    self._include_owners = include_owners
+    self._writer.writerow([
+      column for column in CSV_COLUMNS if include_owners or column != 'telegram_user_id'
+    ])
+
+  def write(self, workshop, event):
+    start, end = (moment.astimezone(SGT) for moment in event_span(event))
+    all_day = 'dateTime' not in event['start']
+    row = [
+      workshop,
+      start.date().isoformat(),
+      '' if all_day else start.strftime('%H:%M'),
+      '' if all_day else end.strftime('%H:%M'),
+      event.get('location', ''),
+      # Holds the name and course users typed in
+      event.get('description', ''),
+    ]
+    if self._include_owners:
+      row.append(booking_owner(event) or '')
+    row += [event['id'], event.get('created', '')]
+    self._writer.writerow([_cell(value) for value in row])
+
+  def close(self):
+    pass
+
+
+class IcsWriter:
+  def __init__(self, out, include_owners = False):
+    self._out = out
+    self._stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    self._line('BEGIN:VCALENDAR')
+    self._line('VERSION:2.0')
+    self._line('PRODID:-//workshopschedulebot//export//EN')
+
+  def write(self, workshop, event):
+    start, end = event_span(event)
+    self._line('BEGIN:VEVENT')
+    self._line(f"UID:{event['id']}")
+    self._line(f'DTSTAMP:{self._stamp}')
+    if 'dateTime' in event['start']:
+      self._line(f"DTSTART:{start.astimezone(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}")
+      self._line(f"DTEND:{end.astimezone(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}")
+    else:
+      self._line(f"DTSTART;VALUE=DATE:{start.strftime('%Y%m%d')}")
+      self._line(f"DTEND;VALUE=DATE:{end.strftime('%Y%m%d')}")
+    self._line(f"SUMMARY:{_escape(event.get('summary', ''))}")
+    if event.get('location'):
+      self._line(f"LOCATION:{_escape(event['location'])}")
+    if event.get('description'):
+      self._line(f"DESCRIPTION:{_escape(event['description'])}")
+    self._line(f'CATEGORIES:{_escape(workshop)}')
+    self._line('END:VEVENT')
+
+  def close(self):
+    self._line('END:VCALENDAR')
+
+  def _line(self, line):
+    # RFC 5545: lines end in CRLF and are folded at 75 octets
+    folded = []
+    current = ''
+    for char in line:
+      if len((current + char).encode()) > 75:
+        folded.append(current)
+        current = ' '
+      current += char
+    folded.append(current)
+    self._out.write('\r\n'.join(folded) + '\r\n')
+
+
+def _cell(value):
+  # A leading quote makes spreadsheets show the text instead of evaluating it
+  value = str(value)
+  return "'" + value if value.startswith(FORMULA_PREFIXES) else value
+
+
+def _escape(text):
+  return text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+
+WRITERS = {'csv': CsvWriter, 'ics': IcsWriter}
+
+
+async def export_events(sources, time_min, time_max, file_format, progress = None, include_owners = False):
+  """Stream every event in [time_min, time_max) into a CSV or ICS file.
+
+  `sources` is a list of (workshop name, gateway); their calendars are
+  exported one after another into the same file, each event tagged with
+  its workshop. Bookers' Telegram IDs are only included with
+  `include_owners`. Pages of events().list are written out as they arrive, into a temporary
+  file that only stays in memory while it is small. `progress(count)` is
+  awaited at most every PROGRESS_INTERVAL seconds. Returns (file, count);
+  the file is positioned at the start and the caller closes it.
+  """
+  document = tempfile.SpooledTemporaryFile(max_size = SPOOL_SIZE)
+  out = io.TextIOWrapper(document, encoding = 'utf-8', newline = '')
+  writer = WRITERS[file_format](out, include_owners)
+  count = 0
+  reported = time.monotonic()
+  reported_count = 0
+
+  try:
+    for workshop, gateway in sources:
+      page_token = None
+      while True:
+        result = await gateway.list_events(
+          timeMin = time_min.isoformat(), timeMax = time_max.isoformat(), singleEvents = True, orderBy = 'startTime',
+          timeZone = 'Asia/Singapore', maxResults = EXPORT_PAGE_SIZE, pageToken = page_token,
+        )
+        for event in result.get('items', []):
+          if event.get('status') != 'cancelled':
+            writer.write(workshop, event)
+            count += 1
+        page_token = result.get('nextPageToken')
+        # An unchanged count would be an edit to the same text, which Telegram rejects
+        if progress and count != reported_count and time.monotonic() - reported >= PROGRESS_INTERVAL:
+          reported = time.monotonic()
+          reported_count = count
+          await progress(count)
+        if not page_token:
+          break
+
+    writer.close()
+    out.flush()
+  except BaseException:
+    # Closing the wrapper closes the temporary file too, so a part-written file is not left behind
+    out.close()
+    raise
+  # Hand back the binary file; detaching keeps it open when the wrapper goes away
+  out.detach()
+  document.seek(0)
+  return document, count
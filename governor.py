@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import os
+import random
+import sys
+import time
+
+from googleapiclient.errors import HttpError
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Calendar requests per second we allow ourselves, and how many may be sent in a burst
+CALENDAR_RATE = float(os.getenv('CalendarRate', '5'))
+CALENDAR_BURST = float(os.getenv('CalendarBurst', '10'))
+# Attempts per request before giving up, and the backoff before the first retry / cap on any retry (seconds)
+MAX_ATTEMPTS = int(os.getenv('CalendarMaxAttempts', '5'))
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 16.0
+# Consecutive failures that open the circuit, and how long it stays open (seconds)
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30.0
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+
+
+class CalendarUnavailable(Exception):
+  """The Calendar API could not be reached: retries ran out or the circuit is open."""
+
+
+def is_retryable(error):
+  if isinstance(error, HttpError):
+    if error.resp.status in RETRYABLE_STATUSES:
+      return True
+    if error.resp.status == 403:
+      details = error.error_details if isinstance(error.error_details, list) else []
+      return any(isinstance(detail, dict) and detail.get('reason') in RATE_LIMIT_REASONS for detail in details)
+    return False
+  # Timeouts, dropped connections and DNS failures
+  return isinstance(error, network_errors())
+
+
+def network_errors():
+  """Exception types for a request that never got an answer.
+
+  httplib2 and google-auth wrap some of these in their own exceptions, e.g.
+  httplib2.ServerNotFoundError. They are looked up only once imported, so
+  this does not undo the lazy load of the Google client stack; a request
+  cannot have raised them before that.
+  """
+  errors = [OSError]
+  httplib2 = sys.modules.get('httplib2')
+  if httplib2 is not None:
+    errors.append(httplib2.HttpLib2Error)
+  auth_exceptions = sys.modules.get('google.auth.exceptions')
+  if auth_exceptions is not None:
+    errors.append(auth_exceptions.TransportError)
+  return tuple(errors)
+
+
+def backoff_delay(attempt):
+  """Full-jitter exponential backoff before retry number `attempt` (0-based)."""
+  return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+class TokenBucket:
+  """Admits requests at a steady rate; callers over the rate wait in FIFO order."""
+
+  def __init__(self, rate = CALENDAR_RATE, capacity = CALENDAR_BURST):
+    self.rate = rate
+    self.capacity = capacity
+    self._tokens = capacity
+    self._updated = time.monotonic()
+    self._lock = asyncio.Lock()
+
+  async def acquire(self, tokens = 1):
+    # A batch may cost more than the bucket holds; it goes into debt and later callers wait it off
+    async with self._lock:
+      while True:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+          self._tokens -= tokens
+          return
+        await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class CircuitBreaker:
+  """Stops sending requests after repeated failures, then lets one trial through per cooldown."""
+
+  def __init__(self, threshold = BREAKER_THRESHOLD, cooldown = BREAKER_COOLDOWN):
+    self.threshold = threshold
+    self.cooldown = cooldown
+    self._failures = 0
+    self._opened_at = None
+    self._trial_in_flight = False
+
+  def before_request(self):
+    """Raise CalendarUnavailable while the circuit is open. Returns True if this request is the half-open trial."""
+    if self._opened_at is None:
+      return False
+    if self._trial_in_flight or time.monotonic() - self._opened_at < self.cooldown:
+      raise CalendarUnavailable('Calendar circuit is open')
+    # Half-open: this request is the trial
+    self._trial_in_flight = True
+    return True
+
+  def release_trial(self):
+    """The trial request was cancelled; it says nothing about the API, so let the next request be the trial."""
+    self._trial_in_flight = False
+
+  def record_success(self):
+    if self._opened_at is not None:
+      logger.info('Calendar circuit closed.')
+    self._failures = 0
+    self._opened_at = None
+    self._trial_in_flight = False
+
+  def record_failure(self):
+    self._failures += 1
+    self._trial_in_flight = False
+    if self._failures >= self.threshold:
+      if self._opened_at is None:
+        logger.warning('Calendar circuit opened after %s consecutive failures.', self._failures)
+        metrics.increment('calendar_circuit_opened_total')
+      self._opened_at = time.monotonic()
+
+
+class RequestGovernor:
+  """Central gate for Calendar requests: rate limiting, retries with backoff, and a circuit breaker."""
+
+  def __init__(self, bucket = None, breaker = None, max_attempts = MAX_ATTEMPTS):
+    self.bucket = bucket or TokenBucket()
+    self.breaker = breaker or CircuitBreaker()
+    self.max_attempts = max_attempts
+
+  async def call(self, attempt_fn, cost = 1):
+    """Await `attempt_fn()` until it succeeds, retrying quota and server errors."""
+    for attempt in range(self.max_attempts):
+      trial = self.breaker.before_request()
+      try:
+        await self.bucket.acquire(cost)
+        result = await attempt_fn()
+      except asyncio.CancelledError:
+        if trial:
+          self.breaker.release_trial()
+        raise
+      except Exception as error:
+        if not is_retryable(error):
+          # The API answered, so it is up; the request itself was wrong
+          self.breaker.record_success()
+          raise
+        self.breaker.record_failure()
+        if attempt == self.max_attempts - 1:
+          raise CalendarUnavailable(f'Calendar request failed after {self.max_attempts} attempts: {error}') from error
+        delay = backoff_delay(attempt)
+        metrics.increment('calendar_retries_total', error = type(error).__name__)
+        logger.info('Retrying Calendar request in %.2f s after: %s', delay, error)
+        await asyncio.sleep(delay)
+      else:
+        self.breaker.record_success()
+        return result
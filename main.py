@@ -1,22 +1,75 @@
+import time
+# Taken before anything else is imported, so the startup log covers the whole import chain
+STARTED = time.perf_counter()
+
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ConversationHandler, ContextTypes, CallbackQueryHandler
+from telegram.error import BadRequest, TelegramError
 
 from datetime import datetime
 import datetime as dt
+import asyncio
+import contextlib
+import html
+import logging
 import os
+import secrets
+import sqlite3
+import uuid
 from dotenv import load_dotenv
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+from calendar_auth import CredentialManager
+from event_cache import SGT, event_span
+from export import export_events
+from governor import CalendarUnavailable
+from metrics import instrument, metrics, setup_logging
+from persistence import build_persistence
+from reminders import FanOut
+from schedule import SCHEDULE_FILE
+from status_message import StatusMessage
+from user_index import USER_PROPERTY
+from webhook import run_webhook
+from workshops import WORKSHOPS_FILE, load_workshops
+
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 Token = os.getenv('Token')
 Botname = '@workshopschedulebot'
 CalendarID = os.getenv('CalendarID')
 
+# 'polling' (default) or 'webhook'. Webhook mode serves updates on PORT at WebhookURL + WebhookPath.
+Mode = os.getenv('Mode', 'polling')
+WebhookURL = os.getenv('WebhookURL', '').rstrip('/')
+WebhookPath = os.getenv('WebhookPath', '/telegram')
+WebhookSecret = os.getenv('WebhookSecret')
+Port = int(os.getenv('PORT', '8080'))
+
+# Where conversation state and half-entered bookings are kept across restarts: 'file' (default), 'sqlite' or 'none'.
+# Either store belongs to one bot process; it is read only at startup
+Persistence = os.getenv('Persistence', 'file')
+PersistenceFile = os.getenv('PersistenceFile')
+# How often buffered conversation changes are written out (seconds)
+PersistenceInterval = float(os.getenv('PersistenceInterval', '10'))
+
+# 'queued' (default) confirms bookings from a durable local log and writes them to the calendar in the background;
+# 'direct' writes to the calendar before answering
+BookingMode = os.getenv('BookingMode', 'queued')
+BookingQueueFile = os.getenv('BookingQueueFile', 'bookings.sqlite3')
+
+# Registry of the workshops this bot serves, each with its own calendar, locations and periods.
+# Without it the bot serves the one calendar in CalendarID with the grid below.
+WorkshopsFile = os.getenv('WorkshopsFile', WORKSHOPS_FILE)
+# Periods and locations of the default workshop; changes are picked up without a restart
+ScheduleFile = os.getenv('ScheduleFile', SCHEDULE_FILE)
+
+# Comma-separated Telegram user IDs allowed to use /export, with the bookers' Telegram IDs in the file.
+# Unset lets anyone export what /bookings already shows, without the Telegram IDs.
+AdminIDs = {int(admin) for admin in os.getenv('AdminIDs', '').split(',') if admin.strip()}
+
+# Built-in schedule, used until the schedule file exists
 start_times = [
   '0730', '0815', '0830', '0915', '1030', '1115',
   '1300', '1345', '1500', '1545', '1630',
@@ -29,45 +82,207 @@ locations = [
   'UNKNOWN LOCATION', 'Location 1', 'Location 2', 'Location 3', 'Location 4'
 ]
 
-DATE, TIME_START, TIME_END, LOCATION, NAME, COURSE, CONFIRMBOOKING, SHOWBOOKINGS = range(8)
+DATE, TIME_START, TIME_END, LOCATION, NAME, COURSE, CONFIRMBOOKING, SHOWBOOKINGS, BULK_DATES, AVAILABILITY, CANCELBOOKING, WORKSHOP = range(12)
+
+CONFIRM_KEYBOARD = InlineKeyboardMarkup([
+  [InlineKeyboardButton("YES", callback_data = 'YES')],
+  [InlineKeyboardButton("NO", callback_data = 'NO')],
+])
+
+# A queued booking's result replaces its panel if it comes within this time; later results are sent as a new message (seconds)
+RESULT_EDIT_WINDOW = 30
+
+# Longest date range accepted by /bulkbook (days)
+MAX_BULK_DAYS = 90
+WEEKDAYS = ['MON', 'TUE', 'WED', 'THU', 'FRI', 'SAT', 'SUN']
+# Longest date range accepted by /bookings (days)
+MAX_VIEW_DAYS = 31
+# Telegram rejects messages longer than this (characters)
+MESSAGE_LIMIT = 4096
+# Longest date range accepted by /export (days)
+MAX_EXPORT_DAYS = 400
+# Most bookings offered as buttons by /cancel_booking ('Cancel all' covers the rest)
+MAX_CANCEL_BUTTONS = 20
 
 # The API scope you're requesting
 SCOPES = ['https://www.googleapis.com/auth/calendar']
 
 
-def check_existing_event(service, start_datetime, end_datetime, location):
-  """Check if an event already exists at the specified time and location."""
-  # Convert start and end datetime to the proper format for the API
-  start_str = start_datetime.strftime('%Y-%m-%dT%H:%M:%S+08:00')  # Explicit timezone offset for Singapore (UTC+8)
-  end_str = end_datetime.strftime('%Y-%m-%dT%H:%M:%S+08:00')  # Explicit timezone offset for Singapore (UTC+8)
+# How often to check whether the Calendar token is close to expiring (seconds)
+CREDENTIAL_CHECK_INTERVAL = 60
+# How often the event cache pulls incremental changes from the calendar (seconds)
+CACHE_SYNC_INTERVAL = float(os.getenv('CacheSyncInterval', '30'))
+# How often due reminders are sent out (seconds)
+REMINDER_TICK = 15
+# How often schedule files are checked for changes (seconds)
+SCHEDULE_CHECK_INTERVAL = 30
+# How often a metrics snapshot is written to the log (seconds)
+METRICS_DUMP_INTERVAL = float(os.getenv('MetricsInterval', '300'))
+
+credentials = CredentialManager(SCOPES)
+
+
+# Build the shared Calendar service once (blocking, runs on the gateway's thread pool).
+# The Google client stack is imported here rather than at startup; /start and plain messages never need it.
+def build_service():
+  from googleapiclient.discovery import build_from_document
+  from googleapiclient.discovery_cache import get_static_doc
+
+  # The discovery document ships with the client library, so building never touches the network
+  return build_from_document(get_static_doc("calendar", "v3"), credentials = credentials.get())
+
+
+# One keep-alive HTTP client per calendar worker thread
+def build_http():
+  import httplib2
+  from google_auth_httplib2 import AuthorizedHttp
+
+  return AuthorizedHttp(credentials.get(), http = httplib2.Http(timeout = 30))
+
+
+# Every workshop the bot serves, keyed by ID. Each has its own gateway, cache, indexes and booking queue.
+workshops = load_workshops(WorkshopsFile, build_service, build_http, {
+  'id': 'default', 'name': 'Workshop', 'calendar_id': CalendarID, 'queue_file': BookingQueueFile, 'schedule': ScheduleFile,
+  'start_times': start_times, 'end_times': end_times, 'locations': locations,
+})
+
+
+def check_existing_event(workshop, date, starting_period, ending_period, location):
+  """Check if an event already exists at the specified periods and location."""
+  logger.debug('Checking for existing events on %s from Period %s to Period %s at location: %s', date, starting_period, ending_period, workshop.locations[location])
+
+  # Test the booked-period bitmask for this date and location
+  if not workshop.slot_index.is_free(date, location, starting_period, ending_period):
+    logger.info('Conflict detected! An event already exists at %s during this time.', workshop.locations[location])
+    return True  # Conflict found
+
+  # No conflict found
+  logger.debug('No clashing events found. Booking event.')
+  return False
+
+
+# The workshop of the booking in progress (the first one for conversations saved before there were several)
+def current_workshop(context: ContextTypes.DEFAULT_TYPE):
+  return workshops.get(context.user_data.get('workshop')) or next(iter(workshops.values()))
+
+
+# A location as shown to users, with its workshop when the bot serves several
+def location_label(workshop, location):
+  return place_label(workshop, workshop.locations[location])
+
+
+# The same for a location name, e.g. from an event that may predate the current schedule
+def place_label(workshop, place):
+  if len(workshops) > 1:
+    return f'{place} ({workshop.name})'
+  return place
 
-  print(f"Checking for existing events from {start_str} to {end_str} at location: {locations[location]}")  # Debugging line
 
+# Sync the slot index if it is stale. On Calendar errors the last known state is used; confirmbooking re-checks anyway.
+async def refresh_availability(workshop):
   try:
-    # Call the API to get events in the specified time range
-    events_result = service.events().list(
-      calendarId = CalendarID,
-      timeMin = start_str,
-      timeMax = end_str,
-      timeZone = "Asia/Singapore"
-    ).execute()
-
-    # If there are events, check for overlap at the same location
-    events = events_result.get('items', [])
-    for event in events:
-      # Check if the event location matches
-      if 'location' in event and event['location'] == locations[location]:
-        print(f"Conflict detected! An event already exists at {locations[location]} during this time.")
-        return True  # Conflict found
+    await workshop.event_cache.ensure_fresh()
+  except (HttpError, CalendarUnavailable) as error:
+    logger.warning('Could not refresh availability of %s: %s', workshop.id, error)
 
-    
-    # No conflict found
-    print("No clashing events found. Booking event.")
+
+# Sync every workshop's cache concurrently. Returns the workshops whose calendar could not be reached.
+async def ensure_fresh_all():
+  results = await asyncio.gather(
+    *(workshop.event_cache.ensure_fresh() for workshop in workshops.values()), return_exceptions = True)
+  unreachable = []
+  for workshop, result in zip(workshops.values(), results):
+    if isinstance(result, (HttpError, CalendarUnavailable)):
+      logger.error('Could not reach the calendar of %s: %s', workshop.id, result)
+      unreachable.append(workshop)
+    elif isinstance(result, BaseException):
+      raise result
+  return unreachable
+
+
+# Dates of the booking in progress (several for a bulk booking)
+def booking_days(context: ContextTypes.DEFAULT_TYPE):
+  dates = context.user_data.get('bulk_dates') or [context.user_data['date']]
+  return [datetime.strptime(date, '%d%m%y').date() for date in dates]
+
+
+# Keyboards offer anything that is free on at least one of the booking's dates
+def bookable_starts(context: ContextTypes.DEFAULT_TYPE):
+  workshop = current_workshop(context)
+  periods = set()
+  for day in booking_days(context):
+    periods.update(workshop.slot_index.bookable_starts(day, workshop.bookable_locations))
+  return sorted(periods)
+
+
+def bookable_ends(context: ContextTypes.DEFAULT_TYPE, starting_period):
+  workshop = current_workshop(context)
+  periods = set()
+  for day in booking_days(context):
+    periods.update(workshop.slot_index.bookable_ends(day, starting_period, workshop.bookable_locations))
+  return sorted(periods)
+
+
+def bookable_locations(context: ContextTypes.DEFAULT_TYPE, starting_period, ending_period):
+  workshop = current_workshop(context)
+  location_ids = set()
+  for day in booking_days(context):
+    location_ids.update(workshop.slot_index.free_locations(day, starting_period, ending_period, workshop.bookable_locations))
+  return sorted(location_ids)
+
+
+# Keyboards are cached by the schedule, one per distinct set of buttons
+def period_keyboard(workshop, periods):
+  return workshop.schedule.period_keyboard(tuple(periods))
+
+
+def location_keyboard(workshop, location_ids):
+  return workshop.schedule.location_keyboard(tuple(location_ids))
+
+
+# Show a step of a booking in its panel: the one bot message the conversation is edited into.
+# Text and keyboard change together in a single edit. The first step, or a panel that can no longer be edited, posts a new one.
+async def show_panel(update: Update, context: ContextTypes.DEFAULT_TYPE, text, reply_markup = None):
+  if update.callback_query:
+    # Whatever message the button was on becomes the panel
+    message = update.callback_query.message
+    context.user_data['panel'] = (message.chat.id, message.message_id)
+
+  panel = context.user_data.get('panel')
+  if panel:
+    chat_id, message_id = panel
+    try:
+      await context.bot.edit_message_text(text, chat_id = chat_id, message_id = message_id, reply_markup = reply_markup)
+      return
+    except BadRequest as error:
+      if 'not modified' in error.message:
+        return
+      logger.debug('Could not edit panel %s: %s', panel, error)
+
+  message = await update.effective_message.reply_text(text, reply_markup = reply_markup)
+  context.user_data['panel'] = (message.chat.id, message.message_id)
+
+
+# Stop the button's loading spinner straight away, without making the handler wait for it
+async def answer_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+  context.application.create_task(update.callback_query.answer(), update = update)
+
+
+# A conversation started under an older schedule may refer to periods that no longer exist.
+# Every step after the date checks this, typed answers as well as buttons.
+async def schedule_changed(update: Update, context: ContextTypes.DEFAULT_TYPE):
+  schedule = current_workshop(context).schedule
+  if context.user_data.get('schedule_version', schedule.version) == schedule.version:
     return False
-  
-  except HttpError as error:
-    print(f"An error occurred while checking for existing events: {error}")
-    return False  # Assuming no conflict in case of an error
+  await show_panel(update, context, 'The timetable was updated while you were booking. Please start again.')
+  return True
+
+
+# Buttons for every workshop, two to a row
+def workshop_keyboard():
+  buttons = [InlineKeyboardButton(workshop.name, callback_data = workshop.id) for workshop in workshops.values()]
+  return InlineKeyboardMarkup([buttons[i:i + 2] for i in range(0, len(buttons), 2)])
+
 
 # Checking for valid date format
 def checkdateformat(input_date):
@@ -86,19 +301,303 @@ def checkdatepast(input_date):
   return past.date() > present.date()
 
 
+# Expand a bulk booking range such as '011225-191225 MON,THU' into DDMMYY dates. Returns (dates, error message).
+def parse_bulk_dates(text):
+  example = 'Eg: 011225-191225 MON,THU'
+  parts = text.upper().split()
+  bounds = parts[0].split('-') if parts else []
+  if len(parts) > 2 or len(bounds) != 2 or not all(checkdateformat(bound) for bound in bounds):
+    return None, f'Date range format is invalid. Please enter a valid range. {example}'
+  if not checkdatepast(bounds[0]):
+    return None, f'Cannot put a past date. Please enter a valid range. {example}'
+
+  first, last = (datetime.strptime(bound, '%d%m%y') for bound in bounds)
+  if last < first:
+    return None, f'The range cannot end before it starts. Please enter a valid range. {example}'
+  if (last - first).days >= MAX_BULK_DAYS:
+    return None, f'The range cannot be longer than {MAX_BULK_DAYS} days. Please enter a shorter range. {example}'
+
+  weekdays = set(range(7))
+  if len(parts) == 2:
+    names = parts[1].split(',')
+    if not all(name in WEEKDAYS for name in names):
+      return None, f'Weekdays are invalid. Use MON, TUE, WED, THU, FRI, SAT or SUN. {example}'
+    weekdays = {WEEKDAYS.index(name) for name in names}
+
+  days = (first + dt.timedelta(days = offset) for offset in range((last - first).days + 1))
+  dates = [day.strftime('%d%m%y') for day in days if day.weekday() in weekdays]
+  if not dates:
+    return None, f'No dates in that range fall on the chosen weekdays. {example}'
+  return dates, None
+
+
+# Parse a /bookings query: 'DDMMYY', 'DDMMYY-DDMMYY' or 'WEEK'. Returns (first day, last day, error message).
+def parse_view_range(text):
+  example = 'Eg: 311225, 291225-021226 or WEEK'
+  text = text.strip().upper()
+  if text == 'WEEK':
+    # The seven days from tomorrow, the first bookable day
+    first = datetime.now().date() + dt.timedelta(days = 1)
+    return first, first + dt.timedelta(days = 6), None
+
+  bounds = text.split('-')
+  if len(bounds) > 2 or not all(checkdateformat(bound) for bound in bounds):
+    return None, None, f'Date format is invalid. Please enter a valid date or range. {example}'
+  if not checkdatepast(bounds[0]):
+    return None, None, f'Cannot put a past date. Please enter a valid date or range. {example}'
+
+  first, last = (datetime.strptime(bound, '%d%m%y').date() for bound in (bounds[0], bounds[-1]))
+  if last < first:
+    return None, None, f'The range cannot end before it starts. Please enter a valid range. {example}'
+  if (last - first).days >= MAX_VIEW_DAYS:
+    return None, None, f'The range cannot be longer than {MAX_VIEW_DAYS} days. Please enter a shorter range. {example}'
+  return first, last, None
+
+
+# Lines listing the events of each day, grouped by location
+def schedule_lines(workshop, events, first, last):
+  by_day = {}
+  for event in events:
+    start, end = event_span(event)
+    start, end = start.astimezone(SGT), end.astimezone(SGT)
+    day = max(start.date(), first)
+    while day <= min((end - dt.timedelta(microseconds = 1)).date(), last):
+      by_day.setdefault(day, []).append((event, start, end))
+      day += dt.timedelta(days = 1)
+
+  def location_order(location):
+    if location in workshop.locations:
+      return (workshop.locations.index(location), '')
+    return (len(workshop.locations), location)
+
+  lines = []
+  for day in sorted(by_day):
+    lines.append(day.strftime('%d %b %Y (%a)'))
+    by_location = {}
+    for event, start, end in by_day[day]:
+      by_location.setdefault(event.get('location', 'No location provided'), []).append((event, start, end))
+    for location in sorted(by_location, key = location_order):
+      lines.append(f'{location}:')
+      for event, start, end in by_location[location]:
+        description = event.get('description', 'No description provided')
+        times = f"{start.strftime('%H%M')} - {end.strftime('%H%M')}" if 'dateTime' in event['start'] else 'All day'
+        lines.append(f"  {times}  {description}")
+    lines.append('')
+  return lines
+
+
+# Pack lines into as few messages as fit under Telegram's size limit
+def split_messages(lines, limit = MESSAGE_LIMIT):
+  messages = []
+  current = []
+  size = 0
+  for line in lines:
+    # A single overlong line is cut rather than dropped
+    for offset in range(0, max(len(line), 1), limit):
+      piece = line[offset:offset + limit]
+      if current and size + len(piece) + 1 > limit:
+        messages.append('\n'.join(current))
+        current, size = [], 0
+      current.append(piece)
+      size += len(piece) + 1
+  if current:
+    messages.append('\n'.join(current))
+  return messages
+
+
+# Monospace grid of periods (rows) by bookable locations (columns) for one date.
+# Cached on the schedule and keyed on the occupancy masks, so a date is only re-rendered after its bookings change.
+def availability_table(schedule, day, occupancy, workshop_name = None):
+  return schedule.cached('availability_table', (day, occupancy, workshop_name),
+                         lambda: render_availability_table(schedule, day, occupancy, workshop_name))
+
+
+def render_availability_table(schedule, day, occupancy, workshop_name):
+  header = f"{'Period':<7}{'Time':<11}" + ''.join(f'{location:>4}' for location in schedule.bookable_locations)
+  rows = [header]
+  for period in range(len(schedule.periods)):
+    bit = 1 << period
+    cells = ''.join(f"{'X' if mask & bit else '-':>4}" for mask in occupancy)
+    rows.append(f'{period:<7}{schedule.start_times[period]}-{schedule.end_times[period]}  {cells}')
+  legend = ', '.join(f'{location} = {schedule.locations[location]}' for location in schedule.bookable_locations)
+  title = f"Availability for {day.strftime('%d %b %Y (%a)')}"
+  if workshop_name:
+    title += f' at {workshop_name}'
+  return (f"{html.escape(title)}\n"
+          f"<pre>{html.escape(chr(10).join(rows))}</pre>\n"
+          f"- free, X booked\n{html.escape(legend)}")
+
+
+# Send the grid of every workshop for a DDMMYY date. Returns an error message for bad input, otherwise None.
+async def send_availability(message, text):
+  if not checkdateformat(text):
+    return 'Date format is invalid. Please enter a valid date. Eg: 311225'
+  day = datetime.strptime(text, '%d%m%y').date()
+  if day < datetime.now().date():
+    return 'Cannot put a past date. Please enter a valid date. Eg: 311225'
+
+  # All workshops sync concurrently, at most one incremental call each; the grids are then read from the slot indexes
+  await asyncio.gather(*(refresh_availability(workshop) for workshop in workshops.values()))
+  for workshop in workshops.values():
+    occupancy = tuple(workshop.slot_index.occupied(day, location) for location in workshop.bookable_locations)
+    workshop_name = workshop.name if len(workshops) > 1 else None
+    await message.reply_text(availability_table(workshop.schedule, day, occupancy, workshop_name), parse_mode = 'HTML')
+  return None
+
+
+# One line describing a booking, e.g. for /mybookings
+def booking_line(workshop, event):
+  start, end = (moment.astimezone(SGT) for moment in event_span(event))
+  line = f"{start.strftime('%d %b %Y (%a)')} {start.strftime('%H%M')} - {end.strftime('%H%M')}, {event.get('location', 'No location provided')}"
+  if len(workshops) > 1:
+    line += f' ({workshop.name})'
+  return line
+
+
+# The user's bookings at every workshop that have not started yet, earliest first, as (workshop, event) pairs
+def upcoming_bookings(user_id):
+  now = datetime.now(SGT)
+  bookings = [
+    (workshop, workshop.event_cache.get(event_id))
+    for workshop in workshops.values()
+    for event_id in workshop.user_index.bookings(user_id, after = now)
+  ]
+  return sorted(bookings, key = lambda booking: event_span(booking[1])[0])
+
+
+# Calendar event body for one booking
+def booking_event(workshop, day, starting_period, ending_period, location, name, course, user_id):
+  schedule = workshop.schedule
+  start_time_obj = schedule.periods[starting_period][0]
+  end_time_obj = schedule.periods[ending_period][1]
+
+  return {
+    # Our own ID makes a retried insert idempotent
+    "id": uuid.uuid4().hex,
+    "summary": "My Python Event",
+    "location": schedule.locations[location],
+    "description": f"Booked by {name} for {course}",
+    "colorId": schedule.color_ids[location],
+    "start": {
+      "dateTime": datetime.combine(day, start_time_obj).isoformat(),
+      "timeZone": "Asia/Singapore"
+    },
+    "end": {
+      "dateTime": datetime.combine(day, end_time_obj).isoformat(),
+      "timeZone": "Asia/Singapore"
+    },
+    # Lets /mybookings and /cancel_booking find the user's bookings without parsing descriptions
+    "extendedProperties": {"private": {USER_PROPERTY: str(user_id)}},
+  }
+
+
+# Added when a booking is in the calendar but the check for a clashing booking made at the same moment could not run
+UNVERIFIED_NOTE = ("The calendar could not be checked again after booking, so a clash with a booking made at the same moment "
+                   "cannot be ruled out. Please check /mybookings in a few minutes.")
+
+
+# Message sent once a booking is in the calendar
+# Worded from the event itself, so a queued booking that resolves after a schedule reload is still described right
+def confirmation_text(workshop, name, course, event):
+  start, end = (moment.astimezone(SGT) for moment in event_span(event))
+  return f"""
+          Your booking has been confirmed!
+
+Booking details:
+          Date: {start.strftime("%d %b %Y")}
+          Time: {start.strftime('%H%M')} - {end.strftime('%H%M')}
+          Location: {place_label(workshop, event.get('location', 'No location provided'))}
+          Booked by: {name}
+          Course/Reason: {course}
+
+You can view your booking at: {event.get('htmlLink')}"""
+
+
 # Commands (/whatever then the bot will do stuff)
+@instrument
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
   await update.message.reply_text('Hello! How can I assist you?')
 
 
 # Define the function to start the booking process
+@instrument
 async def bookslot(update: Update, context: ContextTypes.DEFAULT_TYPE):
-  print(f'User ({update.message.chat.id}): Started booking.')
-  await update.message.reply_text('Which date would you like to book? Put in format DDMMYY. Eg: 311225')
+  logger.info('User (%s): Started booking.', update.message.chat.id, extra = {'chat_id': update.message.chat.id})
+  context.user_data.pop('bulk_dates', None)
+  context.user_data['bulk'] = False
+  # Every booking gets a new panel
+  context.user_data.pop('panel', None)
+  return await ask_workshop(update, context)
+
+
+# Start a booking of the same periods and location over many days
+@instrument
+async def bulkbook(update: Update, context: ContextTypes.DEFAULT_TYPE):
+  logger.info('User (%s): Started bulk booking.', update.message.chat.id, extra = {'chat_id': update.message.chat.id})
+  context.user_data['bulk'] = True
+  context.user_data.pop('panel', None)
+  return await ask_workshop(update, context)
+
+
+# Ask which workshop to book at, unless there is only one
+async def ask_workshop(update: Update, context: ContextTypes.DEFAULT_TYPE):
+  if len(workshops) > 1:
+    await show_panel(update, context, 'Which workshop would you like to book?', workshop_keyboard())
+    return WORKSHOP
+  context.user_data['workshop'] = next(iter(workshops))
+  return await ask_booking_dates(update, context)
+
+
+async def ask_booking_dates(update: Update, context: ContextTypes.DEFAULT_TYPE, intro = ''):
+  if context.user_data.get('bulk'):
+    await show_panel(update, context, intro + 'Which dates would you like to book? Put in a range DDMMYY-DDMMYY, optionally followed by weekdays. Eg: 011225-191225 MON,THU')
+    return BULK_DATES
+  await show_panel(update, context, intro + 'Which date would you like to book? Put in format DDMMYY. Eg: 311225')
   return DATE
 
 
+# Handle the workshop chosen for the booking
+@instrument
+async def handle_workshop(update: Update, context: ContextTypes.DEFAULT_TYPE):
+  query = update.callback_query
+  if query.data not in workshops:
+    await show_panel(update, context, 'That workshop is no longer available. Please select another workshop.', workshop_keyboard())
+    return WORKSHOP
+
+  context.user_data['workshop'] = query.data
+  return await ask_booking_dates(update, context, f'Workshop is {workshops[query.data].name}.\n')
+
+
+# Handle the user input for the bulk booking dates
+@instrument
+async def handle_bulk_dates(update: Update, context: ContextTypes.DEFAULT_TYPE):
+  dates, error_message = parse_bulk_dates(update.message.text)
+  if error_message:
+    await show_panel(update, context, error_message)
+    return BULK_DATES  # Stay in the BULK_DATES state
+
+  # Store the dates in context to use later
+  context.user_data['bulk_dates'] = dates
+  context.user_data['date'] = dates[0]
+
+  # Only offer periods that are still free on one or more of the dates
+  workshop = current_workshop(context)
+  context.user_data['schedule_version'] = workshop.schedule.version
+  await refresh_availability(workshop)
+  free_starts = bookable_starts(context)
+  if not free_starts:
+    await show_panel(update, context, 'All workshops are fully booked on those dates. Please enter another range. Eg: 011225-191225 MON,THU')
+    return BULK_DATES  # Stay in the BULK_DATES state
+
+  # Send buttons for the user to choose a time slot
+  await show_panel(update, context, f'{len(dates)} dates selected. Please select the start time for the bookings.',
+                   period_keyboard(workshop, free_starts))
+
+  return TIME_START  # Transition to the TIME_START state
+
+
 # Handle the user input for the date with validation
+@instrument
 async def handle_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
   date = update.message.text
   
@@ -108,76 +607,67 @@ async def handle_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if checkdatepast(date):
       # Store the valid date in context to use later
       context.user_data['date'] = date
-      await update.message.reply_text('Date is valid. Please select the start time for the booking.')
-      # Define time slots as buttons
-      keyboard = [
-        [InlineKeyboardButton("Period 0 (0730 - 0815)", callback_data = 0)],
-        [InlineKeyboardButton("Period 1 (0815 - 0830)", callback_data = 1),
-        InlineKeyboardButton("Period 2 (0830 - 0915)", callback_data = 2)],
-        [InlineKeyboardButton("Period 3 (0915 - 1000)", callback_data = 3),
-        InlineKeyboardButton("Period 4 (1030 - 1115)", callback_data = 4)],
-        [InlineKeyboardButton("Period 5 (1115 - 1200)", callback_data = 5),
-        InlineKeyboardButton("Period 6 (1300 - 1345)", callback_data = 6)],
-        [InlineKeyboardButton("Period 7 (1345 - 1430)", callback_data = 7),
-        InlineKeyboardButton("Period 8 (1500 - 1545)", callback_data = 8)],
-        [InlineKeyboardButton("Period 9 (1545 - 1630)", callback_data = 9),
-        InlineKeyboardButton("Period 10 (1630 - 1715)", callback_data = 10)],
-      ]
-      reply_markup = InlineKeyboardMarkup(keyboard)
+
+      # Only offer periods that are still free at one or more locations
+      workshop = current_workshop(context)
+      context.user_data['schedule_version'] = workshop.schedule.version
+      await refresh_availability(workshop)
+      free_starts = bookable_starts(context)
+      if not free_starts:
+        await show_panel(update, context, 'All workshops are fully booked on that date. Please enter another date. Eg: 311225')
+        return DATE  # Stay in the DATE state
 
       # Send buttons for the user to choose a time slot
-      await update.message.reply_text('Please select a time slot:', reply_markup = reply_markup)
+      await show_panel(update, context, 'Date is valid. Please select the start time for the booking.', period_keyboard(workshop, free_starts))
 
       return TIME_START  # Transition to the TIME_START state
     else:
       # Date is in the past
-      await update.message.reply_text('Cannot put a past date. Please enter a valid date. Eg: 311225')
+      await show_panel(update, context, 'Cannot put a past date. Please enter a valid date. Eg: 311225')
       return DATE  # Stay in the DATE state
   else:
     # Date format is invalid
-    await update.message.reply_text('Date format is invalid. Please enter a valid date. Eg: 311225')
+    await show_panel(update, context, 'Date format is invalid. Please enter a valid date. Eg: 311225')
     return DATE  # Stay in the DATE state
 
 
 # Handle the user input for the start time
+@instrument
 async def handle_time_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
   # Store the start period input
   query = update.callback_query
+  if await schedule_changed(update, context):
+    return ConversationHandler.END
   starting_period = int(query.data)
+  workshop = current_workshop(context)
 
   # Store the starting period in context to use later
   context.user_data['starting_period'] = starting_period
 
-  await query.message.edit_text(f'Starting period is Period {starting_period}. Please select the ending period for the booking.')
+  # Only offer ending periods that keep the whole range free at one or more locations
+  free_ends = bookable_ends(context, starting_period)
+  if not free_ends:
+    await show_panel(update, context, f'Period {starting_period} is no longer available. Please select another starting period.',
+                     period_keyboard(workshop, bookable_starts(context)))
+    return TIME_START  # Stay in the TIME_START state
 
-  # Define time slots as buttons
-  keyboard = [
-    [InlineKeyboardButton("Period 0 (0730 - 0815)", callback_data = '0')],
-    [InlineKeyboardButton("Period 1 (0815 - 0830)", callback_data = '1'),
-    InlineKeyboardButton("Period 2 (0830 - 0915)", callback_data = '2')],
-    [InlineKeyboardButton("Period 3 (0915 - 1000)", callback_data = '3'),
-    InlineKeyboardButton("Period 4 (1030 - 1115)", callback_data = '4')],
-    [InlineKeyboardButton("Period 5 (1115 - 1200)", callback_data = '5'),
-    InlineKeyboardButton("Period 6 (1300 - 1345)", callback_data = '6')],
-    [InlineKeyboardButton("Period 7 (1345 - 1430)", callback_data = '7'),
-    InlineKeyboardButton("Period 8 (1500 - 1545)", callback_data = '8')],
-    [InlineKeyboardButton("Period 9 (1545 - 1630)", callback_data = '9'),
-    InlineKeyboardButton("Period 10 (1630 - 1715)", callback_data = '10')],
-  ]
-  reply_markup = InlineKeyboardMarkup(keyboard)
-  
   # Send buttons for the user to choose a time slot
-  await query.message.reply_text('Please select a time slot:', reply_markup = reply_markup)
+  await show_panel(update, context, f'Starting period is Period {starting_period}. Please select the ending period for the booking.',
+                   period_keyboard(workshop, free_ends))
 
   return TIME_END  # Transition to the TIME_END state
 
 
 # Handle the user input for the end time with validation
+@instrument
 async def handle_time_end(update: Update, context: ContextTypes.DEFAULT_TYPE):
   # Store the end period input
   query = update.callback_query
+  if await schedule_changed(update, context):
+    return ConversationHandler.END
   ending_period = int(query.data)
-  print('Ending period received.')
+  workshop = current_workshop(context)
+  logger.debug('Ending period received.')
 
   # Get the starting period from the context
   starting_period = int(context.user_data.get('starting_period'))
@@ -185,82 +675,70 @@ async def handle_time_end(update: Update, context: ContextTypes.DEFAULT_TYPE):
   # Check if the periods are valid (In order)
   if ending_period < starting_period: # Check if the starting period is after ending period
     
-    print('Periods are not valid.')
-    await query.message.edit_text('Ending period cannot be before the starting period. Please select a valid ending period.')
-  
-    # Define time slots as buttons
-    keyboard = [
-      [InlineKeyboardButton("Period 0 (0730 - 0815)", callback_data = '0')],
-      [InlineKeyboardButton("Period 1 (0815 - 0830)", callback_data = '1'),
-      InlineKeyboardButton("Period 2 (0830 - 0915)", callback_data = '2')],
-      [InlineKeyboardButton("Period 3 (0915 - 1000)", callback_data = '3'),
-      InlineKeyboardButton("Period 4 (1030 - 1115)", callback_data = '4')],
-      [InlineKeyboardButton("Period 5 (1115 - 1200)", callback_data = '5'),
-      InlineKeyboardButton("Period 6 (1300 - 1345)", callback_data = '6')],
-      [InlineKeyboardButton("Period 7 (1345 - 1430)", callback_data = '7'),
-      InlineKeyboardButton("Period 8 (1500 - 1545)", callback_data = '8')],
-      [InlineKeyboardButton("Period 9 (1545 - 1630)", callback_data = '9'),
-      InlineKeyboardButton("Period 10 (1630 - 1715)", callback_data = '10')],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-      
+    logger.debug('Periods are not valid.')
     # Send buttons for the user to choose a time slot
-    await query.message.reply_text('Please select a time slot:', reply_markup = reply_markup)
+    await show_panel(update, context, 'Ending period cannot be before the starting period. Please select a valid ending period.',
+                     period_keyboard(workshop, bookable_ends(context, starting_period)))
     return TIME_END  # Stay in the TIME_END state
   
   else:
     # Store the ending period in context to use later
     context.user_data['ending_period'] = ending_period
 
-    await query.message.edit_text(f'Ending period is Period {ending_period}. Please select the location for the booking.')
-    
-    # Define locations as buttons
-    keyboard = [
-      [InlineKeyboardButton("Location 1", callback_data = '1'),
-      InlineKeyboardButton("Location 2", callback_data = '2')],
-      [InlineKeyboardButton("Location 3", callback_data = '3'),
-      InlineKeyboardButton("Location 4", callback_data = '4')],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-      
+    # Only offer locations that are free for the whole range
+    free_locations = bookable_locations(context, starting_period, ending_period)
+    if not free_locations:
+      await show_panel(update, context, f'No location is free from Period {starting_period} to Period {ending_period}. Please select another ending period.',
+                       period_keyboard(workshop, bookable_ends(context, starting_period)))
+      return TIME_END  # Stay in the TIME_END state
+
     # Send buttons for the user to choose a location
-    await query.message.reply_text('Please select a location:', reply_markup = reply_markup)
+    await show_panel(update, context, f'Ending period is Period {ending_period}. Please select the location for the booking.',
+                     location_keyboard(workshop, free_locations))
 
     return LOCATION  # Transition to the LOCATION state
 
 
+@instrument
 async def handle_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
   # Store the location input
   query = update.callback_query
+  if await schedule_changed(update, context):
+    return ConversationHandler.END
   location = int(query.data)
-  print('Location received.')
+  logger.debug('Location received.')
 
   # Store the starting period in context to use later
   context.user_data['location'] = location
 
-  await query.message.edit_text(f'Location is {locations[location]}')
-  await query.message.reply_text('Enter your rank and name. Eg: 3SG Ethan Cole')
+  await show_panel(update, context, f'Location is {location_label(current_workshop(context), location)}.\nEnter your rank and name. Eg: 3SG Ethan Cole')
 
   return NAME  # Transition to the NAME state
 
 
+@instrument
 async def handle_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
+  if await schedule_changed(update, context):
+    return ConversationHandler.END
   # Store the name input
   name = update.message.text
-  print('Name received.')
+  logger.debug('Name received.')
 
   # Store name in context to use later
   context.user_data['name'] = name
 
-  await update.message.reply_text('Enter your course/reason for booking. Eg: BSC, ISC, Works')
+  await show_panel(update, context, 'Enter your course/reason for booking. Eg: BSC, ISC, Works')
 
   return COURSE # Transition to the COURSE state
 
 
+@instrument
 async def handle_course(update: Update, context: ContextTypes.DEFAULT_TYPE):
+  if await schedule_changed(update, context):
+    return ConversationHandler.END
   # Store the name input
   course = update.message.text
-  print('Course received.')
+  logger.debug('Course received.')
 
   # Store course in context to use later
   context.user_data['course'] = course
@@ -270,51 +748,43 @@ async def handle_course(update: Update, context: ContextTypes.DEFAULT_TYPE):
   starting_period = context.user_data.get('starting_period')
   ending_period = context.user_data.get('ending_period')
   location = context.user_data.get('location')
+  workshop = current_workshop(context)
 
   # Confirmation message + buttons
   printed_date = datetime.strptime(date, '%d%m%y')
-  message = f'Booking details:\nDate: {printed_date.strftime("%d %b %Y")}\nTime: {start_times[starting_period]} - {end_times[ending_period]}\nLocation: {locations[location]}'
-
-  await update.message.reply_text(message)
-
-  keyboard = [
-    [InlineKeyboardButton("YES", callback_data = 'YES')],
-    [InlineKeyboardButton("NO", callback_data = 'NO')],
-  ]
+  printed_dates = printed_date.strftime("%d %b %Y")
+  bulk_dates = context.user_data.get('bulk_dates')
+  if bulk_dates:
+    last_date = datetime.strptime(bulk_dates[-1], '%d%m%y')
+    printed_dates = f'{len(bulk_dates)} dates from {printed_dates} to {last_date.strftime("%d %b %Y")}'
+  message = f'Booking details:\nDate: {printed_dates}\nTime: {workshop.start_times[starting_period]} - {workshop.end_times[ending_period]}\nLocation: {location_label(workshop, location)}'
 
-  reply_markup = InlineKeyboardMarkup(keyboard)
-      
-  # Send buttons for the user to choose a location
-  await update.message.reply_text('Confirm booking?', reply_markup = reply_markup)
+  # Send the details with buttons for the user to confirm the booking
+  await show_panel(update, context, f'{message}\n\nConfirm booking?', CONFIRM_KEYBOARD)
 
   # End the conversation after the booking is done
   return CONFIRMBOOKING
 
 
+@instrument
 async def confirmbooking(update: Update, context: ContextTypes.DEFAULT_TYPE):
   query = update.callback_query
   answer = query.data
 
-  if answer == "YES":
-    creds = None
-
-    if os.path.exists("token.json"):
-      creds = Credentials.from_authorized_user_file("token.json")
+  if answer == "YES" and await schedule_changed(update, context):
+    return ConversationHandler.END
 
-    if not creds or not creds.valid:
-      if creds and creds.expired and creds.refresh_token:
-        creds.refresh(Request())
-      else:
-        flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
-        creds = flow.run_local_server(port = 0)
+  elif answer == "YES" and context.user_data.get('bulk_dates'):
+    return await confirm_bulk_booking(query, context)
 
-      with open("token.json", "w") as token:
-        token.write(creds.to_json())
+  elif answer == "YES" and BookingMode == 'queued':
+    return await queue_booking(query, context)
 
-    await query.edit_message_text("Checking booking availibility...")
+  elif answer == "YES":
+    # Interim statuses only show if the calendar is slow; usually the result is the one edit
+    status = StatusMessage(query.edit_message_text)
+    status.update("Checking booking availibility...")
     try:
-      service = build("calendar", "v3", credentials = creds)
-      
       # Get all the data from the context
       date = context.user_data.get('date')
       starting_period = context.user_data.get('starting_period')
@@ -322,64 +792,43 @@ async def confirmbooking(update: Update, context: ContextTypes.DEFAULT_TYPE):
       location = context.user_data.get('location')
       name = context.user_data.get('name')
       course = context.user_data.get('course')
+      workshop = current_workshop(context)
       
-      # Converting the date and times into ISO format
       date_obj = datetime.strptime(date, '%d%m%y')
-      start_time_obj = datetime.strptime(start_times[starting_period], '%H%M').time()
-      end_time_obj = datetime.strptime(end_times[ending_period], '%H%M').time()
-      
-      combined_start_datetime = datetime.combine(date_obj, start_time_obj)
-      start_datetime = combined_start_datetime.isoformat()
-      combined_end_datetime = datetime.combine(date_obj, end_time_obj)
-      end_datetime = combined_end_datetime.isoformat()
-
-      # Check if an event already exists at the same time and location
-      if check_existing_event(service, combined_start_datetime, combined_end_datetime, location):
-        await query.edit_message_text(f"{locations[location]} has already been booked for that time. Please book another slot.")
+      day = date_obj.date()
+
+      # Hold the slot, check it against a fresh cache, insert, then re-verify against other bot instances
+      event = booking_event(workshop, day, starting_period, ending_period, location, name, course, query.from_user.id)
+      [(outcome, result)] = await workshop.reservations.book([(day, location, starting_period, ending_period, event)])
+      if outcome in ('conflict', 'rolled_back'):
+        metrics.increment('bookings_total', outcome = outcome)
+        await status.finish(f"{location_label(workshop, location)} has already been booked for that time. Please book another slot.")
+        return ConversationHandler.END
+      if outcome == 'failed':
+        # The insert error is handled like any other calendar failure below
+        raise result
+      event = result
+
+      if outcome == 'unverified':
+        # The event is in the calendar; only the check for a simultaneous booking elsewhere could not run
+        metrics.increment('bookings_total', outcome = 'unverified')
+        logger.warning('Event created but not re-verified. %s', event.get('htmlLink'), extra = {'event_id': event['id']})
+        await status.finish(confirmation_text(workshop, name, course, event) + "\n\n" + UNVERIFIED_NOTE)
         return ConversationHandler.END
-      
-      # If no conflict, create the event
-      await query.edit_message_text("Processing booking...")
-      event = {
-      "summary": "My Python Event",
-      "location": locations[location],
-      "description": f"Booked by {name} for {course}",
-      "colorId": location,
-      "start": {
-          "dateTime": start_datetime,
-          "timeZone": "Asia/Singapore"
-      },
-          "end": {
-          "dateTime": end_datetime,
-          "timeZone": "Asia/Singapore"
-      },
-      }
-        
-      event = service.events().insert(
-                                      calendarId = CalendarID,
-                                      body = event
-                                      ).execute()
-
-      print(f"Event created. {event.get('htmlLink')}")
-      confirmation_message = f"""
-          Your booking has been confirmed!
-
-Booking details:
-          Date: {date_obj.strftime("%d %b %Y")}
-          Time: {start_times[starting_period]} - {end_times[ending_period]}
-          Location: {locations[location]}
-          Booked by: {name}
-          Course/Reason: {course}
 
-You can view your booking at: {event.get('htmlLink')}"""
-      await query.message.edit_text(confirmation_message)
+      metrics.increment('bookings_total', outcome = 'confirmed')
+      logger.info('Event created. %s', event.get('htmlLink'), extra = {'event_id': event['id']})
+      await status.finish(confirmation_text(workshop, name, course, event))
    
-    except HttpError as error:
-      print("An error occured: ", error)
-      
+    except (HttpError, CalendarUnavailable) as error:
+      metrics.increment('bookings_total', outcome = 'error')
+      logger.error('An error occured: %s', error)
+      await status.finish("Could not reach the calendar. Your booking was not made. Please try again later.")
+
     return ConversationHandler.END
 
   elif query.data == "NO":
+    metrics.increment('bookings_total', outcome = 'declined')
     await query.edit_message_text("Booking terminated.")
     return ConversationHandler.END
   else:
@@ -387,103 +836,337 @@ You can view your booking at: {event.get('htmlLink')}"""
     return ConversationHandler.END
 
 
+# Record the booking in the durable queue and answer at once; the queue worker writes it to the calendar
+async def queue_booking(query, context: ContextTypes.DEFAULT_TYPE):
+  day = datetime.strptime(context.user_data.get('date'), '%d%m%y').date()
+  starting_period = context.user_data.get('starting_period')
+  ending_period = context.user_data.get('ending_period')
+  location = context.user_data.get('location')
+  name = context.user_data.get('name')
+  course = context.user_data.get('course')
+  workshop = current_workshop(context)
+
+  # Queued bookings hold their slots in the index, so this also catches bookings not yet in the calendar
+  if check_existing_event(workshop, day, starting_period, ending_period, location):
+    metrics.increment('bookings_total', outcome = 'conflict')
+    await query.edit_message_text(f"{location_label(workshop, location)} has already been booked for that time. Please book another slot.")
+    return ConversationHandler.END
+
+  body = booking_event(workshop, day, starting_period, ending_period, location, name, course, query.from_user.id)
+  # The worker usually writes the booking within a second; the result then replaces the panel without this status ever showing
+  status = StatusMessage(query.edit_message_text)
+  status.update(
+    f"Your booking of {location_label(workshop, location)} on {day.strftime('%d %b %Y')}, {workshop.start_times[starting_period]} - {workshop.end_times[ending_period]} "
+    "has been received. You will get a message once it is in the calendar."
+  )
+  queued_status[body['id']] = status
+  try:
+    await workshop.booking_queue.enqueue({
+      'id': body['id'], 'chat_id': query.message.chat.id, 'day': day, 'location': location,
+      'starting_period': starting_period, 'ending_period': ending_period, 'name': name, 'course': course, 'body': body,
+    })
+  except sqlite3.Error as error:
+    queued_status.pop(body['id'], None)
+    metrics.increment('bookings_total', outcome = 'error')
+    logger.error('Could not queue booking: %s', error)
+    await status.finish("Your booking could not be recorded. Please try again later.")
+    return ConversationHandler.END
+  metrics.increment('bookings_total', outcome = 'queued')
+  logger.info('Booking queued.', extra = {'event_id': body['id'], 'chat_id': query.message.chat.id})
+  return ConversationHandler.END
+
+
+# Panels of queued bookings waiting for their result, by booking ID (lost on restart; results then come as new messages)
+queued_status = {}
+
+
+# Tell the user how their queued booking turned out
+async def booking_resolved(bot, workshop, booking, status, event):
+  if status == 'booked':
+    text = confirmation_text(workshop, booking['name'], booking['course'], event)
+  elif status == 'conflict':
+    text = (f"Sorry, {place_label(workshop, booking['body']['location'])} on {booking['day'].strftime('%d %b %Y')} was booked by someone else "
+            "before your booking reached the calendar. Please book another slot.")
+  else:
+    text = (f"Your booking of {place_label(workshop, booking['body']['location'])} on {booking['day'].strftime('%d %b %Y')} could not be made. "
+            "Please try again later.")
+  metrics.increment('bookings_total', outcome = f'queued_{status}')
+  panel = queued_status.pop(booking['id'], None)
+  if panel is not None and panel.elapsed() < RESULT_EDIT_WINDOW:
+    await panel.finish(text)
+    return
+  if panel is not None:
+    await panel.stop()
+  await bot.send_message(booking['chat_id'], text)
+
+
+# Book every date of a bulk booking: one sync for the conflict check, then batched inserts
+async def confirm_bulk_booking(query, context: ContextTypes.DEFAULT_TYPE):
+  starting_period = context.user_data.get('starting_period')
+  ending_period = context.user_data.get('ending_period')
+  location = context.user_data.get('location')
+  name = context.user_data.get('name')
+  course = context.user_data.get('course')
+  workshop = current_workshop(context)
+  days = booking_days(context)
+  results = {}
+
+  status = StatusMessage(query.edit_message_text)
+  status.update(f"Checking availability for {len(days)} dates...")
+  try:
+    # One sync for every conflict check, then all free dates in one batch insert
+    bodies = [booking_event(workshop, day, starting_period, ending_period, location, name, course, query.from_user.id) for day in days]
+    outcomes = await workshop.reservations.book([
+      (day, location, starting_period, ending_period, body) for day, body in zip(days, bodies)
+    ])
+    for day, (outcome, result) in zip(days, outcomes):
+      if outcome == 'booked':
+        results[day] = 'Booked'
+      elif outcome == 'unverified':
+        results[day] = 'Booked, not yet verified'
+      elif outcome == 'failed':
+        logger.error('An error occurred while booking %s: %s', day, result)
+        results[day] = 'Failed, please try again'
+      else:
+        results[day] = 'Already booked'
+
+  except (HttpError, CalendarUnavailable) as error:
+    logger.error('An error occured: %s', error)
+    await status.finish("Could not reach the calendar. Please try again later.")
+    return ConversationHandler.END
+
+  for outcome in results.values():
+    metrics.increment('bulk_bookings_total', outcome = outcome)
+  message = f"Bulk booking for {location_label(workshop, location)}, {workshop.start_times[starting_period]} - {workshop.end_times[ending_period]}:\n\n"
+  message += "\n".join(f"{day.strftime('%d %b %Y (%a)')}: {results[day]}" for day in days)
+  if 'Booked, not yet verified' in results.values():
+    message += "\n\n" + UNVERIFIED_NOTE
+  await status.finish(message)
+  return ConversationHandler.END
+
+
 # Define the handler for invalid inputs or cancellations
+@instrument
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
   await update.message.reply_text('Processed cancelled.')
   return ConversationHandler.END
 
 
+@instrument
 async def bookings(update: Update, context: ContextTypes.DEFAULT_TYPE):
-  print(f'User ({update.message.chat.id}): Viewing Bookings.')
-  await update.message.reply_text('Which date would you like to view? Put in format DDMMYY. Eg: 311225')
+  logger.info('User (%s): Viewing Bookings.', update.message.chat.id, extra = {'chat_id': update.message.chat.id})
+  await update.message.reply_text('Which dates would you like to view? Put in a date DDMMYY, a range DDMMYY-DDMMYY or WEEK for the next 7 days. Eg: 311225')
   return SHOWBOOKINGS
 
+@instrument
 async def show_bookings(update: Update, context: ContextTypes.DEFAULT_TYPE):
-  date = update.message.text
-  
-  # Check if the date format is valid
-  if checkdateformat(date):
-    # Check if the date is not in the past
-    if checkdatepast(date):
-      print('Valid date recieved.')
-      creds = None
-
-      if os.path.exists("token.json"):
-        creds = Credentials.from_authorized_user_file("token.json")
-
-      if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-          creds.refresh(Request())
-        else:
-          flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
-          creds = flow.run_local_server(port = 0)
-
-        with open("token.json", "w") as token:
-          token.write(creds.to_json())
-
-      try:
-        reply_message = await update.message.reply_text('Obtaining bookings from calendar...')
-        service = build('calendar', 'v3', credentials = creds)
-        
-        utc_plus_8 = dt.timezone(dt.timedelta(hours = 8))
-        date = datetime.strptime(date, '%d%m%y')
-        time_min = date.replace(hour = 0, minute = 0, second = 0, microsecond = 0, tzinfo = utc_plus_8)
-        time_max = date.replace(hour = 23, minute = 59, second = 59, microsecond = 999999, tzinfo = utc_plus_8)
-
-        printed_date = date.strftime("%d %b %Y")
-
-        # Call the API to get the events
-        events_result = service.events().list(
-            calendarId = CalendarID,
-            timeMin = time_min.isoformat(),
-            timeMax = time_max.isoformat(),
-            timeZone = 'Asia/Singapore',
-            singleEvents = True,
-            orderBy = 'startTime'
-        ).execute()
-
-        events = events_result.get('items', [])
-        events_sorted = sorted(events,
-                               key = lambda event: (event.get('start', {}).get('dateTime', ''), event.get('location', ''))
-                               )
-
-        if not events:
-          await reply_message.edit_text(f"No bookings found for {printed_date}.")
-          return ConversationHandler.END
-          
-        message = f"Here are the bookings for {printed_date}:\n\n"
-
-        for event in events_sorted:
-          # Extracting event start time and end time
-          start = event["start"].get("dateTime", event["start"].get("date"))
-          end = event["end"].get("dateTime", event["end"].get("date"))
-          
-          start = datetime.strptime(start, '%Y-%m-%dT%H:%M:%S%z')
-          end = datetime.strptime(end, '%Y-%m-%dT%H:%M:%S%z')
-          start_time = start.strftime('%H%M')
-          end_time = end.strftime('%H%M')
-          location = event.get("location", "No location provided")
-          description = event.get("description", "No description provided")
-
-          message += f"Time: {start_time} - {end_time}\n"
-          message += f"Location: {location}\n"
-          message += f"Description: {description}\n"
-          message += "-" * 40 + "\n"
-
-        await reply_message.edit_text(message)
-        return ConversationHandler.END
+  first, last, error_message = parse_view_range(update.message.text)
+  if error_message:
+    await update.message.reply_text(error_message)
+    return SHOWBOOKINGS  # Stay in the SHOWBOOKINGS state
 
-      except HttpError as error:
-        print(f"An error occurred: {error}")
+  logger.debug('Valid date range recieved.')
+  reply_message = await update.message.reply_text('Obtaining bookings from calendar...')
+  # Each cache holds its whole calendar (paged events().list with sync tokens), so one sync per workshop covers any range
+  unreachable = await ensure_fresh_all()
+  if len(unreachable) == len(workshops):
+    await reply_message.edit_text('Could not reach the calendar. Please try again later.')
+    return ConversationHandler.END
 
-    else:
-      # Date is in the past
-      await update.message.reply_text('Cannot put a past date. Please enter a valid date. Eg: 311225')
-      return SHOWBOOKINGS  # Stay in the SHOWBOOKINGS state
+  time_min = datetime.combine(first, dt.time(), tzinfo = SGT)
+  time_max = datetime.combine(last + dt.timedelta(days = 1), dt.time(), tzinfo = SGT)
+  printed_range = first.strftime('%d %b %Y')
+  if last != first:
+    printed_range += f" to {last.strftime('%d %b %Y')}"
+
+  lines = []
+  for workshop in workshops.values():
+    if workshop in unreachable:
+      lines += [f'{workshop.name}: could not reach the calendar.', '']
+      continue
+    events = workshop.event_cache.events_between(time_min, time_max)
+    if events and len(workshops) > 1:
+      lines += [f'== {workshop.name} ==', '']
+    lines += schedule_lines(workshop, events, first, last)
+  if not lines:
+    await reply_message.edit_text(f"No bookings found for {printed_range}.")
+    return ConversationHandler.END
+
+  # Long schedules go out as several messages, each under Telegram's size limit
+  messages = split_messages([f"Here are the bookings for {printed_range}:", ''] + lines)
+  await reply_message.edit_text(messages[0])
+  for message in messages[1:]:
+    await update.message.reply_text(message)
+  return ConversationHandler.END
+
+
+# List the user's upcoming bookings
+@instrument
+async def mybookings(update: Update, context: ContextTypes.DEFAULT_TYPE):
+  if len(await ensure_fresh_all()) == len(workshops):
+    await update.message.reply_text('Could not reach the calendar. Please try again later.')
+    return
+
+  bookings = upcoming_bookings(update.effective_user.id)
+  if not bookings:
+    await update.message.reply_text('You have no upcoming bookings.')
+    return
+
+  lines = [f'Your upcoming bookings ({len(bookings)}):', ''] + [booking_line(workshop, event) for workshop, event in bookings]
+  for message in split_messages(lines):
+    await update.message.reply_text(message)
+
+
+# Start cancelling one or all of the user's upcoming bookings
+@instrument
+async def cancel_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
+  logger.info('User (%s): Cancelling a booking.', update.message.chat.id, extra = {'chat_id': update.message.chat.id})
+  if len(await ensure_fresh_all()) == len(workshops):
+    await update.message.reply_text('Could not reach the calendar. Please try again later.')
+    return ConversationHandler.END
+
+  bookings = upcoming_bookings(update.effective_user.id)
+  if not bookings:
+    await update.message.reply_text('You have no upcoming bookings.')
+    return ConversationHandler.END
+
+  keyboard = [
+    [InlineKeyboardButton(booking_line(workshop, event), callback_data = f"{workshop.id}:{event['id']}")]
+    for workshop, event in bookings[:MAX_CANCEL_BUTTONS]
+  ]
+  keyboard.append([
+    InlineKeyboardButton(f"Cancel all ({len(bookings)})", callback_data = 'ALL'),
+    InlineKeyboardButton("Keep all", callback_data = 'KEEP'),
+  ])
+  await update.message.reply_text('Which booking would you like to cancel?', reply_markup = InlineKeyboardMarkup(keyboard))
+  return CANCELBOOKING
+
+
+@instrument
+async def handle_cancel_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
+  query = update.callback_query
+  user_id = query.from_user.id
+
+  if query.data == 'KEEP':
+    await query.edit_message_text('No bookings were cancelled.')
+    return ConversationHandler.END
+  # Event IDs to delete, per workshop
+  selected = {}
+  if query.data == 'ALL':
+    for workshop, event in upcoming_bookings(user_id):
+      selected.setdefault(workshop, []).append(event['id'])
   else:
-    # Date format is invalid
-    await update.message.reply_text('Date format is invalid. Please enter a valid date. Eg: 311225')
-    return SHOWBOOKINGS  # Stay in the SHOWBOOKINGS state
+    workshop_id, _, event_id = query.data.partition(':')
+    workshop = workshops.get(workshop_id)
+    if workshop is None or workshop.user_index.owner(event_id) != user_id:
+      await query.edit_message_text('That booking is no longer yours to cancel.')
+      return ConversationHandler.END
+    selected[workshop] = [event_id]
+  if not selected:
+    # Everything has started or was deleted elsewhere since the keyboard was shown
+    await query.edit_message_text('No bookings were cancelled.')
+    return ConversationHandler.END
+
+  await query.edit_message_text(f"Cancelling {sum(map(len, selected.values()))} booking(s)...")
+  # One batch request per workshop, all workshops at once
+  results = await asyncio.gather(
+    *(workshop.gateway.delete_events_batch(event_ids) for workshop, event_ids in selected.items()), return_exceptions = True)
+
+  lines = []
+  cancelled = 0
+  for (workshop, event_ids), errors in zip(selected.items(), results):
+    if isinstance(errors, (HttpError, CalendarUnavailable)):
+      logger.error('An error occurred: %s', errors)
+      errors = [errors] * len(event_ids)
+    elif isinstance(errors, BaseException):
+      raise errors
+    for event_id, error in zip(event_ids, errors):
+      event = workshop.event_cache.get(event_id)
+      if error is None:
+        cancelled += 1
+        if event is not None:
+          lines.append(f'Cancelled: {booking_line(workshop, event)}')
+        workshop.event_cache.remove(event_id)
+      else:
+        logger.error('Could not cancel event %s: %s', event_id, error)
+        lines.append(f"Failed, please try again: {booking_line(workshop, event) if event is not None else event_id}")
+  metrics.increment('cancellations_total', amount = cancelled)
+
+  # Bookings already gone from the cache have no line of their own
+  messages = split_messages(lines) or [f'Cancelled {cancelled} booking(s).']
+  await query.edit_message_text(messages[0])
+  for message in messages[1:]:
+    await query.message.reply_text(message)
+  return ConversationHandler.END
+
+
+# Send every booking in a date range as a CSV or ICS file: /export DDMMYY-DDMMYY [csv|ics]
+@instrument
+async def export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+  usage = 'Usage: /export DDMMYY-DDMMYY [csv|ics]. Eg: /export 010125-300625 csv'
+  if AdminIDs and update.effective_user.id not in AdminIDs:
+    await update.message.reply_text('Only admins can export bookings.')
+    return
+
+  args = [arg.lower() for arg in context.args]
+  bounds = args[0].split('-') if args else []
+  file_format = args[1] if len(args) > 1 else 'csv'
+  if len(args) > 2 or len(bounds) != 2 or not all(checkdateformat(bound) for bound in bounds) or file_format not in ('csv', 'ics'):
+    await update.message.reply_text(usage)
+    return
+  first, last = (datetime.strptime(bound, '%d%m%y').date() for bound in bounds)
+  if last < first or (last - first).days >= MAX_EXPORT_DAYS:
+    await update.message.reply_text(f'The range must run forwards and cover at most {MAX_EXPORT_DAYS} days. {usage}')
+    return
+
+  logger.info('User (%s): Exporting %s to %s.', update.effective_user.id, first, last, extra = {'chat_id': update.message.chat.id})
+  status = await update.message.reply_text('Exporting bookings...')
+
+  async def progress(count):
+    # Progress is only a courtesy; a failed edit must not abort the export
+    with contextlib.suppress(TelegramError):
+      await status.edit_text(f'Exporting bookings... {count} so far.')
+
+  time_min = datetime.combine(first, dt.time(), tzinfo = SGT)
+  time_max = datetime.combine(last + dt.timedelta(days = 1), dt.time(), tzinfo = SGT)
+  try:
+    sources = [(workshop.name, workshop.gateway) for workshop in workshops.values()]
+    document, count = await export_events(sources, time_min, time_max, file_format, progress,
+                                          include_owners = update.effective_user.id in AdminIDs)
+  except (HttpError, CalendarUnavailable) as error:
+    logger.error('An error occurred: %s', error)
+    await status.edit_text('Could not reach the calendar. Please try again later.')
+    return
+
+  # python-telegram-bot buffers uploads whole, so only the finished file is read into memory (bots may send up to 50 MB)
+  with document:
+    content = document.read()
+  filename = f"bookings-{first.strftime('%Y%m%d')}-{last.strftime('%Y%m%d')}.{file_format}"
+  await update.message.reply_document(content, filename = filename, caption = f'{count} bookings.')
+  metrics.increment('exports_total', format = file_format)
+  await status.edit_text(f'Exported {count} bookings.')
+
+
+# Show which periods are free at every location on a date: /availability or /availability DDMMYY
+@instrument
+async def availability(update: Update, context: ContextTypes.DEFAULT_TYPE):
+  if context.args:
+    error_message = await send_availability(update.message, context.args[0])
+    if error_message:
+      await update.message.reply_text(error_message)
+    return ConversationHandler.END
+
+  await update.message.reply_text('Which date would you like to check? Put in format DDMMYY. Eg: 311225')
+  return AVAILABILITY
+
+
+@instrument
+async def show_availability(update: Update, context: ContextTypes.DEFAULT_TYPE):
+  error_message = await send_availability(update.message, update.message.text.strip())
+  if error_message:
+    await update.message.reply_text(error_message)
+    return AVAILABILITY  # Stay in the AVAILABILITY state
+  return ConversationHandler.END
 
 
 # Responses (reads and handles responses, without /whatever)
@@ -495,11 +1178,12 @@ def handle_response(text: str) -> str:
 
 
 # Handles messages from private or groups
+@instrument
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
   message_type: str = update.message.chat.type
   text: str = update.message.text
 
-  print(f'User ({update.message.chat.id}) in {message_type}: "{text}"')
+  logger.info('User (%s) in %s: "%s"', update.message.chat.id, message_type, text)
 
   if message_type == 'group':
     if Botname in text:
@@ -510,30 +1194,119 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
   else:
     response:str = handle_response(text)
 
-  print('Bot:', response)
+  logger.info('Bot: %s', response)
   await update.message.reply_text(response)
 
 
 #Error handling
 async def error(update: Update, context: ContextTypes.DEFAULT_TYPE):
-  print(f'Update {update} caused error {context.error}')
+  metrics.increment('update_errors_total', error = type(context.error).__name__)
+  logger.error('Update %s caused error %s', update, context.error, exc_info = context.error)
   if isinstance(update, Update):
     if update.message:
-      print(f"Error Message: {update.message.text}")
+      logger.error('Error Message: %s', update.message.text)
     elif update.callback_query:
-      print(f"Error Callback Query: {update.callback_query.data}")
+      logger.error('Error Callback Query: %s', update.callback_query.data)
 
 
-def main():
-  application = Application.builder().token(Token).build()
+# Refresh the Calendar token in the background so no booking waits on it
+async def refresh_credentials(context: ContextTypes.DEFAULT_TYPE):
+  try:
+    # Credentials are shared; any workshop's thread pool will do
+    await next(iter(workshops.values())).gateway.run(credentials.refresh_if_due)
+  except Exception as error:
+    logger.error('Could not refresh calendar credentials: %s', error)
+
+
+# Pick up edited schedule files
+async def reload_schedules(context: ContextTypes.DEFAULT_TYPE):
+  for workshop in workshops.values():
+    workshop.reload_schedule()
+
+
+# Keep every workshop's event cache fresh between queries; a slow or failing calendar does not hold up the others
+async def sync_calendar(context: ContextTypes.DEFAULT_TYPE):
+  results = await asyncio.gather(
+    *(workshop.event_cache.refresh() for workshop in workshops.values()), return_exceptions = True)
+  for workshop, result in zip(workshops.values(), results):
+    if isinstance(result, Exception):
+      logger.warning('Could not sync calendar of %s: %s', workshop.id, result)
 
+
+# Send every reminder that has come due. One job serves all bookings; the heap says what is due.
+async def dispatch_reminders(context: ContextTypes.DEFAULT_TYPE):
+  due = [reminder for workshop in workshops.values() for reminder in workshop.reminders.due()]
+  if due:
+    logger.info('Sending %s reminders.', len(due))
+    # Sending may take a while when many reminders share a period boundary; do not hold up the next tick
+    context.application.create_task(context.job.data.send(due))
+
+
+# Periodic metrics dump, so polling deployments without a /metrics endpoint still get numbers
+async def dump_metrics(context: ContextTypes.DEFAULT_TYPE):
+  logger.info('Metrics snapshot', extra = {'metrics': metrics.snapshot()})
+
+
+# Load credentials and build the Calendar service off the event loop once the bot is up, so the first booking does not pay for it
+async def warm_up_calendar(workshop):
+  try:
+    await workshop.gateway.run(lambda: workshop.gateway.service)
+  except Exception as error:
+    logger.warning('Could not warm up the calendar client of %s: %s', workshop.id, error)
+
+
+async def post_init(application: Application):
+  metrics.observe('startup_seconds', time.perf_counter() - STARTED)
+  logger.info('Bot ready in %.3f s.', time.perf_counter() - STARTED)
+  for workshop in workshops.values():
+    application.create_task(warm_up_calendar(workshop))
+  application.job_queue.run_repeating(refresh_credentials, interval = CREDENTIAL_CHECK_INTERVAL, first = 0)
+  application.job_queue.run_repeating(sync_calendar, interval = CACHE_SYNC_INTERVAL, first = 1)
+  application.job_queue.run_repeating(reload_schedules, interval = SCHEDULE_CHECK_INTERVAL, first = SCHEDULE_CHECK_INTERVAL)
+  application.job_queue.run_repeating(dump_metrics, interval = METRICS_DUMP_INTERVAL, first = METRICS_DUMP_INTERVAL)
+  application.job_queue.run_repeating(dispatch_reminders, interval = REMINDER_TICK, first = REMINDER_TICK,
+                                      data = FanOut(application.bot))
+
+  # Bookings left pending by the last run keep their slots and are flushed by each workshop's worker
+  application.bot_data['booking_workers'] = []
+  for workshop in workshops.values():
+    workshop.booking_queue.open(
+      lambda booking, status, event, workshop = workshop: booking_resolved(application.bot, workshop, booking, status, event))
+    application.bot_data['booking_workers'].append(application.create_task(workshop.booking_queue.run()))
+
+
+# Stop the booking workers and release the calendar thread pools when the bot stops
+async def shutdown(application: Application):
+  for worker in application.bot_data.get('booking_workers', []):
+    worker.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+      await worker
+  for workshop in workshops.values():
+    workshop.booking_queue.close()
+    workshop.gateway.shutdown()
+  logger.info('Metrics snapshot', extra = {'metrics': metrics.snapshot()})
+  if log_listener:
+    log_listener.stop()
+
+
+# Register every handler on the application (also used by bench.py)
+def add_handlers(application: Application):
   #Commands
   application.add_handler(CommandHandler('start', start))
+  application.add_handler(CommandHandler('mybookings', mybookings))
+  application.add_handler(CommandHandler('export', export))
+
+  # Webhook responses answer callback queries for free (see run_webhook); polling spends a call on each
+  if Mode != 'webhook':
+    application.add_handler(CallbackQueryHandler(answer_callback), group = -1)
   
   conversation_handler = ConversationHandler(
     entry_points = [
       CommandHandler("bookslot", bookslot),
       CommandHandler("bookings", bookings),
+      CommandHandler("bulkbook", bulkbook),
+      CommandHandler("availability", availability),
+      CommandHandler("cancel_booking", cancel_booking),
     ],
     states = {
       DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_date)],
@@ -544,8 +1317,14 @@ def main():
       COURSE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_course)],
       CONFIRMBOOKING: [CallbackQueryHandler(confirmbooking)],
       SHOWBOOKINGS: [MessageHandler(filters.TEXT & ~filters.COMMAND, show_bookings)],
+      BULK_DATES: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_bulk_dates)],
+      AVAILABILITY: [MessageHandler(filters.TEXT & ~filters.COMMAND, show_availability)],
+      CANCELBOOKING: [CallbackQueryHandler(handle_cancel_booking)],
+      WORKSHOP: [CallbackQueryHandler(handle_workshop)],
     },
     fallbacks = [CommandHandler('cancel', cancel)],
+    name = 'booking',
+    persistent = application.persistence is not None,
   )
 
   # Add the conversation handler to the application
@@ -557,9 +1336,36 @@ def main():
   #Errors
   application.add_error_handler(error)
 
-  #Polling (Checks for new messages)
-  print('Polling...')
-  application.run_polling()
+
+log_listener = None
+
+
+def main():
+  global log_listener
+  log_listener = setup_logging()
+
+  builder = Application.builder().token(Token).post_init(post_init).post_shutdown(shutdown)
+  persistence = build_persistence(Persistence, PersistenceFile, PersistenceInterval)
+  if persistence:
+    builder = builder.persistence(persistence)
+  application = builder.build()
+  add_handlers(application)
+
+  if Mode == 'webhook':
+    # Telegram pushes updates to our HTTP server
+    if not WebhookURL:
+      raise SystemExit('WebhookURL must be set when Mode is webhook.')
+    secret_token = WebhookSecret
+    if not secret_token:
+      # Instances behind a load balancer must share WebhookSecret, or the last one started locks out the rest
+      secret_token = secrets.token_urlsafe(32)
+      logger.warning('WebhookSecret is not set. Using a random secret for this process.')
+    logger.info('Serving webhook on port %s...', Port)
+    asyncio.run(run_webhook(application, WebhookURL, WebhookPath, secret_token, '0.0.0.0', Port, metrics, answer_callbacks = True))
+  else:
+    #Polling (Checks for new messages)
+    logger.info('Polling...')
+    application.run_polling()
 
 if __name__ == '__main__':
   main()
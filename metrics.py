@@ -0,0 +1,164 @@
+import bisect
+import functools
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from collections import Counter
+from logging.handlers import QueueHandler, QueueListener
+
+# Upper bounds of the latency histogram buckets (seconds)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Attributes every LogRecord has; anything else was passed through `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'taskName'}
+
+
+class Histogram:
+  def __init__(self):
+    self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+    self.count = 0
+    self.sum = 0.0
+
+  def observe(self, value):
+    self.buckets[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+    self.count += 1
+    self.sum += value
+
+  def quantile(self, fraction):
+    """Upper bound of the bucket holding the given quantile (inf if past the last bucket)."""
+    if not self.count:
+      return 0.0
+    rank = fraction * self.count
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS + (float('inf'),), self.buckets):
+      seen += count
+      if seen >= rank:
+        return bound
+    return float('inf')
+
+
+class Metrics:
+  """Thread-safe counters and latency histograms, cheap enough to leave on.
+
+  Calendar calls are recorded from the gateway's worker threads, so updates
+  take a lock; each one is a dict lookup and a few additions.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._counters = Counter()
+    self._histograms = {}
+
+  def increment(self, name, amount = 1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with self._lock:
+      self._counters[key] += amount
+
+  def observe(self, name, seconds, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with self._lock:
+      histogram = self._histograms.get(key)
+      if histogram is None:
+        histogram = self._histograms[key] = Histogram()
+      histogram.observe(seconds)
+
+  def snapshot(self):
+    """Summary of every metric, for the periodic log dump."""
+    with self._lock:
+      counters = [
+        {'name': name, **dict(labels), 'value': value}
+        for (name, labels), value in sorted(self._counters.items())
+      ]
+      histograms = [
+        {
+          'name': name, **dict(labels), 'count': histogram.count,
+          'mean_ms': round(histogram.sum / histogram.count * 1000, 1),
+          'p50_ms': histogram.quantile(0.5) * 1000, 'p99_ms': histogram.quantile(0.99) * 1000,
+        }
+        for (name, labels), histogram in sorted(self._histograms.items())
+      ]
+    return {'counters': counters, 'histograms': histograms}
+
+  def render(self):
+    """Prometheus text exposition of every metric, for the /metrics endpoint."""
+    lines = []
+    with self._lock:
+      for (name, labels), value in sorted(self._counters.items()):
+        lines.append(f'{name}{_labels(labels)} {value}')
+      for (name, labels), histogram in sorted(self._histograms.items()):
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), histogram.buckets):
+          cumulative += count
+          lines.append(f'{name}_bucket{_labels(labels + (("le", bound),))} {cumulative}')
+        lines.append(f'{name}_sum{_labels(labels)} {histogram.sum}')
+        lines.append(f'{name}_count{_labels(labels)} {histogram.count}')
+    return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+  if not labels:
+    return ''
+  return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+metrics = Metrics()
+
+
+def instrument(handler):
+  """Record latency, errors and entries (conversation drop-off) for a handler."""
+  name = handler.__name__
+
+  @functools.wraps(handler)
+  async def wrapper(update, context):
+    metrics.increment('handler_calls_total', handler = name)
+    started = time.perf_counter()
+    try:
+      return await handler(update, context)
+    except Exception:
+      metrics.increment('handler_errors_total', handler = name)
+      raise
+    finally:
+      metrics.observe('handler_latency_seconds', time.perf_counter() - started, handler = name)
+
+  return wrapper
+
+
+class JsonFormatter(logging.Formatter):
+  """One JSON object per line, including any fields passed with `extra`."""
+
+  def format(self, record):
+    entry = {
+      'time': self.formatTime(record),
+      'level': record.levelname,
+      'logger': record.name,
+      'message': record.getMessage(),
+    }
+    for key, value in vars(record).items():
+      if key not in _RECORD_ATTRIBUTES:
+        entry[key] = value
+    if record.exc_info:
+      entry['exception'] = self.formatException(record.exc_info)
+    return json.dumps(entry, default = str)
+
+
+def setup_logging(level = logging.INFO):
+  """Send log records through a queue so handlers never block on stdout.
+
+  Returns the listener thread; stop it on shutdown to flush what is left.
+  """
+  log_queue = queue.SimpleQueue()
+  output = logging.StreamHandler(sys.stdout)
+  output.setFormatter(JsonFormatter())
+  listener = QueueListener(log_queue, output)
+
+  root = logging.getLogger()
+  root.setLevel(level)
+  root.addHandler(QueueHandler(log_queue))
+  # httpx logs every getUpdates poll at INFO
+  logging.getLogger('httpx').setLevel(logging.WARNING)
+
+  listener.start()
+  return listener
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import sqlite3
+
+from telegram.ext import BasePersistence, PersistenceInput, PicklePersistence
+
+# Only conversation states and the half-entered bookings in user_data need to survive a restart
+STORE_DATA = PersistenceInput(bot_data = False, chat_data = False, user_data = True, callback_data = False)
+
+
+class SQLitePersistence(BasePersistence):
+  """Keeps ConversationHandler states and user_data in an SQLite database.
+
+  The Application already collects changes in memory and hands them over every
+  `update_interval` seconds; each round is committed as one transaction. The
+  data is read back only at startup, so this lets conversations survive a
+  restart; it does not let several processes share one database, and
+  changes made since the last round are lost in a crash.
+  """
+
+  def __init__(self, filepath, update_interval = 60):
+    super().__init__(store_data = STORE_DATA, update_interval = update_interval)
+    self._connection = sqlite3.connect(filepath)
+    self._connection.execute('PRAGMA journal_mode = WAL')
+    self._connection.execute('PRAGMA synchronous = NORMAL')
+    self._connection.execute(
+      'CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL)'
+    )
+    self._connection.execute(
+      'CREATE TABLE IF NOT EXISTS conversations (name TEXT NOT NULL, key TEXT NOT NULL, state TEXT NOT NULL, PRIMARY KEY (name, key))'
+    )
+    self._connection.commit()
+    self._commit_scheduled = False
+
+  def _schedule_commit(self):
+    # All writes of one persistence round run before the loop gets to this callback
+    if not self._commit_scheduled:
+      self._commit_scheduled = True
+      asyncio.get_running_loop().call_soon(self._commit)
+
+  def _commit(self):
+    # flush() may have committed and closed the database since this was scheduled
+    if not self._commit_scheduled:
+      return
+    self._commit_scheduled = False
+    self._connection.commit()
+
+  async def get_user_data(self):
+    return {user_id: json.loads(data) for user_id, data in self._connection.execute('SELECT user_id, data FROM user_data')}
+
+  async def update_user_data(self, user_id, data):
+    self._connection.execute('INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)', (user_id, json.dumps(data)))
+    self._schedule_commit()
+
+  async def drop_user_data(self, user_id):
+    self._connection.execute('DELETE FROM user_data WHERE user_id = ?', (user_id,))
+    self._schedule_commit()
+
+  async def get_conversations(self, name):
+    rows = self._connection.execute('SELECT key, state FROM conversations WHERE name = ?', (name,))
+    return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+  async def update_conversation(self, name, key, new_state):
+    if new_state is None:
+      self._connection.execute('DELETE FROM conversations WHERE name = ? AND key = ?', (name, json.dumps(key)))
+    else:
+      self._connection.execute(
+        'INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)',
+        (name, json.dumps(key), json.dumps(new_state)),
+      )
+    self._schedule_commit()
+
+  async def flush(self):
+    self._commit_scheduled = False
+    self._connection.commit()
+    self._connection.close()
+
+  # Chat, bot and callback data are not stored
+  async def get_chat_data(self):
+    return {}
+
+  async def get_bot_data(self):
+    return {}
+
+  async def get_callback_data(self):
+    return None
+
+  async def update_chat_data(self, chat_id, data):
+    pass
+
+  async def update_bot_data(self, data):
+    pass
+
+  async def update_callback_data(self, data):
+    pass
+
+  async def drop_chat_data(self, chat_id):
+    pass
+
+  # Nothing else writes to the database while this process runs, so there is nothing to refresh
+  async def refresh_user_data(self, user_id, user_data):
+    pass
+
+  async def refresh_chat_data(self, chat_id, chat_data):
+    pass
+
+  async def refresh_bot_data(self, bot_data):
+    pass
+
+
+def build_persistence(kind, filepath, update_interval):
+  """Persistence backend for the given kind: 'file' (pickle), 'sqlite', or 'none'."""
+  if kind == 'none':
+    return None
+  if kind == 'sqlite':
+    return SQLitePersistence(filepath or 'bot_data.sqlite3', update_interval = update_interval)
+  return PicklePersistence(filepath or 'bot_data.pickle', store_data = STORE_DATA, update_interval = update_interval)
@@ -0,0 +1,129 @@
+import asyncio
+import heapq
+import logging
+from datetime import datetime, time, timedelta
+
+from telegram.error import Forbidden, RetryAfter, TelegramError
+
+from event_cache import SGT
+from governor import TokenBucket
+from metrics import metrics
+from user_index import booking_owner
+
+logger = logging.getLogger(__name__)
+
+# Reminders go out the evening before a booking and shortly before it starts
+EVENING_REMINDER = time(20, 0)
+LEAD_TIME = timedelta(minutes = 15)
+# Telegram allows about 30 messages a second across all chats; stay under it
+SEND_RATE = 25
+# A reminder that comes due while the bot is down is still sent if it is at most this late
+GRACE = timedelta(minutes = 5)
+
+
+class ReminderScheduler:
+  """Time-ordered reminders for every booking made through the bot.
+
+  The scheduler listens to the EventCache, so the startup sync rebuilds it
+  from the calendar and moved or cancelled bookings update it. All pending
+  reminders sit in one heap; `due()` pops the ones whose time has come.
+  Entries for changed or removed bookings are skipped when popped.
+  """
+
+  def __init__(self, evening = EVENING_REMINDER, lead = LEAD_TIME):
+    self.evening = evening
+    self.lead = lead
+    self._heap = []
+    self._bookings = {}
+    # Reminders already sent, by the time they were due; kept only until a re-sync could no longer schedule them
+    self._sent = {}
+
+  # EventCache listener interface
+  def event_added(self, event, start, end):
+    owner = booking_owner(event)
+    if owner is None or 'dateTime' not in event.get('start', {}):
+      return
+    start, end = start.astimezone(SGT), end.astimezone(SGT)
+    self._bookings[event['id']] = (owner, start, end, event.get('location', 'your workshop'))
+
+    now = datetime.now(SGT)
+    evening = datetime.combine(start.date() - timedelta(days = 1), self.evening, SGT)
+    for kind, at in (('evening', evening), ('soon', start - self.lead)):
+      if at + GRACE > now and (event['id'], kind, start) not in self._sent:
+        heapq.heappush(self._heap, (at, event['id'], kind, start))
+
+  def event_removed(self, event_id):
+    self._bookings.pop(event_id, None)
+
+  def cleared(self):
+    self._bookings.clear()
+    self._heap.clear()
+
+  def due(self, now = None):
+    """Pop the reminders that are due, as a list of (chat ID, text)."""
+    now = now or datetime.now(SGT)
+    reminders = []
+    while self._heap and self._heap[0][0] <= now:
+      at, event_id, kind, start = heapq.heappop(self._heap)
+      booking = self._bookings.get(event_id)
+      # Stale entry: the booking was cancelled or moved since it was scheduled
+      if booking is None or booking[1] != start or (event_id, kind, start) in self._sent:
+        continue
+      self._sent[(event_id, kind, start)] = at
+      if at + GRACE < now:
+        continue
+      reminders.append((booking[0], self._text(kind, booking)))
+
+    for key, at in list(self._sent.items()):
+      if at + GRACE < now:
+        del self._sent[key]
+    return reminders
+
+  def __len__(self):
+    return len(self._heap)
+
+  def _text(self, kind, booking):
+    _, start, end, location = booking
+    times = f"{start.strftime('%H%M')} - {end.strftime('%H%M')}"
+    if kind == 'evening':
+      return f"Reminder: you have booked {location} tomorrow, {start.strftime('%d %b %Y')}, {times}."
+    return f"Reminder: your booking at {location} starts in {int(self.lead.total_seconds() // 60)} minutes ({times})."
+
+
+class FanOut:
+  """Sends batches of messages without tripping Telegram's flood limits.
+
+  Messages for the same chat are joined into one, so no chat gets more
+  than one message per batch; all sends share one global token bucket.
+  """
+
+  def __init__(self, bot, rate = SEND_RATE):
+    self.bot = bot
+    self.bucket = TokenBucket(rate, rate)
+
+  async def send(self, messages):
+    by_chat = {}
+    for chat_id, text in messages:
+      by_chat.setdefault(chat_id, []).append(text)
+    await asyncio.gather(*(self._send(chat_id, '\n\n'.join(texts)) for chat_id, texts in by_chat.items()))
+
+  async def _send(self, chat_id, text):
+    for _ in range(2):
+      await self.bucket.acquire()
+      try:
+        await self.bot.send_message(chat_id, text)
+        metrics.increment('reminders_sent_total')
+        return
+      except RetryAfter as error:
+        # Flood control kicked in anyway; wait as told, then try once more
+        logger.warning('Telegram asked to retry after %s s.', error.retry_after)
+        await asyncio.sleep(error.retry_after.total_seconds() if isinstance(error.retry_after, timedelta) else error.retry_after)
+      except Forbidden:
+        # The user never started a private chat with the bot, or blocked it
+        metrics.increment('reminders_failed_total', reason = 'forbidden')
+        return
+      except TelegramError as error:
+        logger.warning('Could not send reminder to %s: %s', chat_id, error)
+        metrics.increment('reminders_failed_total', reason = type(error).__name__)
+        return
+    metrics.increment('reminders_failed_total', reason = 'RetryAfter')
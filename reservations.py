@@ -0,0 +1,142 @@
+import asyncio
+import contextlib
+import logging
+
+from googleapiclient.errors import HttpError
+
+from governor import CalendarUnavailable
+from slot_index import period_mask
+
+logger = logging.getLogger(__name__)
+
+
+class ReservationLayer:
+  """In-process holds on the periods a booking is about to write.
+
+  A booking holds its (date, location, period range) while it checks and
+  inserts. Only bookings whose ranges overlap wait on each other; bookings
+  for other dates, locations or periods run in parallel. `book()` is the
+  one write path every kind of booking goes through.
+  """
+
+  def __init__(self, gateway, event_cache, slot_index):
+    self._gateway = gateway
+    self._event_cache = event_cache
+    self._slot_index = slot_index
+    self._held = {}
+    self._conditions = {}
+    # Holders and waiters per (date, location); its condition is dropped when the last one leaves
+    self._users = {}
+
+  @contextlib.asynccontextmanager
+  async def hold(self, day, location, first, last):
+    key = (day, location)
+    mask = period_mask(first, last)
+    condition = self._conditions.setdefault(key, asyncio.Condition())
+    self._users[key] = self._users.get(key, 0) + 1
+
+    try:
+      async with condition:
+        await condition.wait_for(lambda: not self._held.get(key, 0) & mask)
+        self._held[key] = self._held.get(key, 0) | mask
+
+      try:
+        yield
+      finally:
+        async with condition:
+          self._held[key] &= ~mask
+          if not self._held[key]:
+            del self._held[key]
+          condition.notify_all()
+    finally:
+      self._users[key] -= 1
+      if not self._users[key]:
+        del self._users[key]
+        del self._conditions[key]
+
+  def lost_to(self, event, day, location, first, last):
+    """Return the booking that owns the slot if `event` collided with one, otherwise None.
+
+    Another process may have inserted an overlapping booking at the same time.
+    The earliest-created event wins (ties broken by ID), so every process
+    agrees on which booking to roll back.
+    """
+    rivals = [
+      self._event_cache.get(event_id)
+      for event_id in self._slot_index.events_overlapping(day, location, first, last)
+    ]
+    rivals.append(event)
+    winner = min(rivals, key = lambda rival: (rival.get('created', ''), rival['id']))
+    return None if winner['id'] == event['id'] else winner
+
+  async def book(self, bookings, include_holds = True):
+    """Write bookings to the calendar, each unless its slot is already taken.
+
+    `bookings` is a list of (day, location, first, last, body). Every slot is
+    held, in (day, location) order so overlapping batches cannot deadlock.
+    One sync brings the cache up to date for the conflict checks and the
+    free bookings go in one batch insert. A booking whose event (same body
+    ID) is already in the calendar, from an attempt that failed part-way,
+    is not inserted again and only goes through the re-verify. A second sync then catches
+    bookings another bot instance made at the same time, and the losers are
+    rolled back. With `include_holds = False` the holds of queued bookings
+    do not count as conflicts.
+
+    Returns one (outcome, result) per booking, in order: ('booked', event),
+    ('conflict', None), ('rolled_back', None), ('failed', insert error) or
+    ('unverified', event) for an event that is in the calendar but could not
+    be re-verified or rolled back. Raises HttpError or CalendarUnavailable if
+    the calendar cannot be synced before anything is inserted.
+    """
+    outcomes = [None] * len(bookings)
+    async with contextlib.AsyncExitStack() as stack:
+      for index in sorted(range(len(bookings)), key = lambda index: bookings[index][:2]):
+        day, location, first, last, _ = bookings[index]
+        await stack.enter_async_context(self.hold(day, location, first, last))
+
+      await self._event_cache.refresh()
+      free = []
+      created = []
+      for index, (day, location, first, last, body) in enumerate(bookings):
+        own_event = self._event_cache.get(body.get('id'))
+        if own_event is not None:
+          # An earlier attempt got this booking into the calendar but failed before it was resolved; only re-verify it
+          created.append((index, own_event))
+        elif self._slot_index.is_free(day, location, first, last, include_holds):
+          free.append(index)
+        else:
+          outcomes[index] = ('conflict', None)
+
+      responses = await self._gateway.insert_events_batch([bookings[index][4] for index in free]) if free else []
+      for index, (event, error) in zip(free, responses):
+        if error is None:
+          self._event_cache.add(event)
+          created.append((index, event))
+        else:
+          outcomes[index] = ('failed', error)
+
+      # Re-verify in case another bot instance booked the same slots meanwhile
+      if created:
+        try:
+          await self._event_cache.refresh()
+        except (HttpError, CalendarUnavailable) as error:
+          # The events are in the calendar already; say so rather than report them as failed
+          logger.warning('Could not re-verify %d new bookings: %s', len(created), error)
+          for index, event in created:
+            outcomes[index] = ('unverified', event)
+          created = []
+      for index, event in created:
+        day, location, first, last, _ = bookings[index]
+        if self.lost_to(event, day, location, first, last):
+          logger.warning('Double booking detected for location %s on %s. Rolling back event %s.', location, day, event['id'])
+          try:
+            await self._gateway.delete_event(event['id'])
+          except (HttpError, CalendarUnavailable) as error:
+            logger.error('Could not roll back event %s: %s', event['id'], error)
+            outcomes[index] = ('unverified', event)
+            continue
+          self._event_cache.remove(event['id'])
+          outcomes[index] = ('rolled_back', None)
+        else:
+          outcomes[index] = ('booked', event)
+    return outcomes
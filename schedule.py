@@ -0,0 +1,100 @@
+import json
+import os
+from datetime import datetime
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+SCHEDULE_FILE = 'schedule.json'
+# Most entries each kind of cached value keeps per schedule
+CACHE_SIZE = 256
+
+
+class Schedule:
+  """A workshop's period grid and locations, parsed once.
+
+  Periods are kept as `time` objects next to their HHMM labels, so booking
+  needs no parsing. Keyboards are built once per set of buttons and then
+  reused; Telegram objects are immutable, so a cached markup is safe to send
+  from any handler. The caches belong to the schedule, so a reloaded schedule
+  takes them with it. Location 0 stands in for events with an unrecognised
+  location and is never offered.
+
+  `version` is the modification time of the file the schedule came from (0
+  for the built-in grid); conversations compare it to notice a reload.
+  """
+
+  def __init__(self, periods, locations, version = 0):
+    self.start_times = tuple(start for start, _ in periods)
+    self.end_times = tuple(end for _, end in periods)
+    self.periods = tuple(
+      (datetime.strptime(start, '%H%M').time(), datetime.strptime(end, '%H%M').time())
+      for start, end in periods
+    )
+    for period, (start, end) in enumerate(self.periods):
+      if start >= end:
+        raise ValueError(f'Period {period} ends before it starts')
+      if period and start < self.periods[period - 1][0]:
+        raise ValueError(f'Period {period} starts before period {period - 1}')
+    if len(locations) < 2:
+      raise ValueError('A schedule needs at least one bookable location')
+    self.locations = tuple(name for name, _ in locations)
+    self.color_ids = tuple(str(color_id) for _, color_id in locations)
+    self.bookable_locations = range(1, len(self.locations))
+    self.version = version
+    self._caches = {}
+
+  @classmethod
+  def from_grid(cls, start_times, end_times, locations, version = 0):
+    """Schedule from parallel lists, colouring each location with its index."""
+    if len(start_times) != len(end_times):
+      raise ValueError('start_times and end_times differ in length')
+    return cls(list(zip(start_times, end_times)), [(name, i) for i, name in enumerate(locations)], version)
+
+  def __repr__(self):
+    return f'Schedule({len(self.periods)} periods, {len(self.locations) - 1} locations, version {self.version})'
+
+  def cached(self, kind, key, build, maxsize = CACHE_SIZE):
+    """Return `build()`, computed once per `key` within `kind`. Once a kind holds `maxsize` entries the oldest is dropped."""
+    cache = self._caches.setdefault(kind, {})
+    if key in cache:
+      return cache[key]
+    if len(cache) >= maxsize:
+      del cache[next(iter(cache))]
+    value = cache[key] = build()
+    return value
+
+  # Buttons for the given periods, two to a row
+  def period_keyboard(self, periods):
+    def build():
+      buttons = [
+        InlineKeyboardButton(f"Period {period} ({self.start_times[period]} - {self.end_times[period]})", callback_data = str(period))
+        for period in periods
+      ]
+      return InlineKeyboardMarkup([buttons[i:i + 2] for i in range(0, len(buttons), 2)])
+    return self.cached('period_keyboard', periods, build, maxsize = 1024)
+
+  # Buttons for the given locations, two to a row
+  def location_keyboard(self, location_ids):
+    def build():
+      buttons = [InlineKeyboardButton(self.locations[location], callback_data = str(location)) for location in location_ids]
+      return InlineKeyboardMarkup([buttons[i:i + 2] for i in range(0, len(buttons), 2)])
+    return self.cached('location_keyboard', location_ids, build)
+
+
+def load_schedule(path):
+  """Read a schedule file.
+
+  The file holds `periods`, a list of [start, end] HHMM pairs, and
+  `locations`, a list of {"name", "color_id"} starting with the entry used
+  for unrecognised locations. Raises OSError or ValueError if it cannot be
+  used.
+  """
+  version = os.stat(path).st_mtime_ns
+  with open(path) as config:
+    data = json.load(config)
+  try:
+    periods = [(start, end) for start, end in data['periods']]
+    locations = [(location['name'], location.get('color_id', i)) for i, location in enumerate(data['locations'])]
+  except (KeyError, TypeError, ValueError) as error:
+    raise ValueError(f'{path} is not a valid schedule: {error!r}') from error
+  return Schedule(periods, locations, version)
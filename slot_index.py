@@ -0,0 +1,166 @@
+from datetime import datetime, timedelta
+
+from event_cache import SGT, event_span
+
+
+def period_mask(first, last):
+  """Bitmask covering periods first..last inclusive."""
+  return ((1 << (last + 1)) - 1) ^ ((1 << first) - 1)
+
+
+class SlotIndex:
+  """Booked periods per (date, location), stored as one bitmask each.
+
+  Bit p of a mask is set when some event at that location overlaps period p
+  on that date, so a conflict check is a single AND. The index listens to the
+  EventCache and stays in step with every sync and insert. Bookings that are
+  queued but not yet in the calendar are laid over the events as holds. A
+  hold keeps the booking's event body and is placed by its times and
+  location name, so it lands on the right periods after a schedule change.
+  """
+
+  def __init__(self, schedule):
+    self._event_masks = {}
+    self._occupancy = {}
+    self._event_keys = {}
+    self._holds = {}
+    self._held = {}
+    self._hold_bodies = {}
+    self.set_schedule(schedule)
+
+  def set_schedule(self, schedule):
+    """Switch to a new period grid. Indexed events are dropped; replay them from the EventCache. Holds are placed again."""
+    self.periods = schedule.periods
+    self._location_ids = {name: i for i, name in enumerate(schedule.locations)}
+    self.cleared()
+    self._holds.clear()
+    self._held.clear()
+    for hold_id in self._hold_bodies:
+      self._place_hold(hold_id)
+
+  def booking_slot(self, body):
+    """(day, location, first, last) of a booking's event body on the current grid.
+
+    Returns None if its location is no longer bookable or its times no longer
+    cover any period.
+    """
+    location = self._location_ids.get(body.get('location'))
+    if not location:
+      return None
+    start, end = (moment.astimezone(SGT) for moment in event_span(body))
+    day = start.date()
+    mask = self._day_mask(day, start, end)
+    if not mask:
+      return None
+    return day, location, (mask & -mask).bit_length() - 1, mask.bit_length() - 1
+
+  def _day_mask(self, day, start, end):
+    """Periods on `day` that overlap start..end."""
+    mask = 0
+    for period, (period_start, period_end) in enumerate(self.periods):
+      if datetime.combine(day, period_start, SGT) < end and datetime.combine(day, period_end, SGT) > start:
+        mask |= 1 << period
+    return mask
+
+  # EventCache listener interface
+  def event_added(self, event, start, end):
+    location = self._location_ids.get(event.get('location'))
+    if location is None:
+      return
+
+    keys = []
+    start = start.astimezone(SGT)
+    end = end.astimezone(SGT)
+    day = start.date()
+    while day <= end.date():
+      mask = self._day_mask(day, start, end)
+      if mask:
+        key = (day, location)
+        self._event_masks.setdefault(key, {})[event['id']] = mask
+        self._occupancy[key] = self._occupancy.get(key, 0) | mask
+        keys.append(key)
+      day += timedelta(days = 1)
+
+    if keys:
+      self._event_keys[event['id']] = keys
+
+  def event_removed(self, event_id):
+    for key in self._event_keys.pop(event_id, ()):
+      masks = self._event_masks[key]
+      del masks[event_id]
+      if masks:
+        occupancy = 0
+        for mask in masks.values():
+          occupancy |= mask
+        self._occupancy[key] = occupancy
+      else:
+        del self._event_masks[key]
+        del self._occupancy[key]
+
+  def cleared(self):
+    self._event_masks.clear()
+    self._occupancy.clear()
+    self._event_keys.clear()
+
+  # Holds for bookings not yet written to the calendar; they survive full syncs and schedule changes
+  def hold(self, hold_id, body):
+    self._hold_bodies[hold_id] = body
+    self._place_hold(hold_id)
+
+  def _place_hold(self, hold_id):
+    slot = self.booking_slot(self._hold_bodies[hold_id])
+    if slot is None:
+      return
+    day, location, first, last = slot
+    key = (day, location)
+    mask = period_mask(first, last)
+    self._holds[hold_id] = (key, mask)
+    self._held[key] = self._held.get(key, 0) | mask
+
+  def release(self, hold_id):
+    self._hold_bodies.pop(hold_id, None)
+    if hold_id not in self._holds:
+      return
+    key, _ = self._holds.pop(hold_id)
+    held = 0
+    for other_key, mask in self._holds.values():
+      if other_key == key:
+        held |= mask
+    if held:
+      self._held[key] = held
+    else:
+      del self._held[key]
+
+  # Queries
+  def occupied(self, day, location, include_holds = True):
+    """Bitmask of booked periods at a location on a date."""
+    occupied = self._occupancy.get((day, location), 0)
+    if include_holds:
+      occupied |= self._held.get((day, location), 0)
+    return occupied
+
+  def is_free(self, day, location, first, last, include_holds = True):
+    return not self.occupied(day, location, include_holds) & period_mask(first, last)
+
+  def events_overlapping(self, day, location, first, last):
+    """IDs of events at a location on a date that touch any of periods first..last."""
+    mask = period_mask(first, last)
+    return [event_id for event_id, event_mask in self._event_masks.get((day, location), {}).items() if event_mask & mask]
+
+  def free_locations(self, day, first, last, locations):
+    """The given locations that are free for all of periods first..last."""
+    return [location for location in locations if self.is_free(day, location, first, last)]
+
+  def bookable_starts(self, day, locations):
+    """Periods that are free at one or more of the given locations."""
+    occupied_everywhere = (1 << len(self.periods)) - 1
+    for location in locations:
+      occupied_everywhere &= self.occupied(day, location)
+    return [period for period in range(len(self.periods)) if not occupied_everywhere & (1 << period)]
+
+  def bookable_ends(self, day, first, locations):
+    """Ending periods that leave first..end free at one or more of the given locations."""
+    return [
+      last for last in range(first, len(self.periods))
+      if self.free_locations(day, first, last, locations)
+    ]
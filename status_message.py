@@ -0,0 +1,76 @@
+import asyncio
+import contextlib
+import logging
+import time
+
+from telegram.error import TelegramError
+
+logger = logging.getLogger(__name__)
+
+# Interim statuses wait this long, so quick operations go straight to their result (seconds)
+STATUS_DELAY = 1.0
+# Least time between interim status edits (seconds)
+STATUS_INTERVAL = 2.0
+
+
+class StatusMessage:
+  """One message that shows the progress of an operation and then its result.
+
+  Texts passed to `update()` are shown no sooner than `delay` after the
+  operation started and then at most every `interval`, and only the latest
+  one is sent. `finish()` replaces them with the result in one edit, so an
+  operation that completes quickly costs a single Bot API call.
+
+  `edit(text, reply_markup = None)` is the coroutine function that edits the
+  message, e.g. `CallbackQuery.edit_message_text`.
+  """
+
+  def __init__(self, edit, delay = STATUS_DELAY, interval = STATUS_INTERVAL):
+    self._edit = edit
+    self.delay = delay
+    self.interval = interval
+    self.started = time.monotonic()
+    self._shown_at = None
+    self._text = None
+    self._task = None
+    self._editing = False
+
+  def elapsed(self):
+    return time.monotonic() - self.started
+
+  def update(self, text):
+    self._text = text
+    if self._task is None:
+      self._task = asyncio.ensure_future(self._show_later())
+
+  async def finish(self, text, reply_markup = None):
+    await self.stop()
+    await self._edit(text, reply_markup = reply_markup)
+
+  async def stop(self):
+    """Drop any status not shown yet. An edit already on its way is let through, so it cannot land after the result."""
+    task, self._task = self._task, None
+    self._text = None
+    if task is None:
+      return
+    if not self._editing:
+      task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+      await task
+
+  async def _show_later(self):
+    due = self.started + self.delay if self._shown_at is None else self._shown_at + self.interval
+    await asyncio.sleep(max(0.0, due - time.monotonic()))
+    text, self._text = self._text, None
+    self._editing = True
+    try:
+      await self._edit(text)
+    except TelegramError as error:
+      logger.debug('Could not show status %r: %s', text, error)
+    finally:
+      self._editing = False
+      self._shown_at = time.monotonic()
+      self._task = None
+    # A newer status arrived while this one was being sent
+    if self._text is not None:
+      self._task = asyncio.ensure_future(self._show_later())
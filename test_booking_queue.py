@@ -0,0 +1,89 @@
+"""Checks of the durable booking queue against the in-memory Calendar from bench.py.
+
+  python -m pytest test_booking_queue.py
+"""
+import asyncio
+import itertools
+import os
+from datetime import date, timedelta
+
+import main
+from bench import FakeCalendar
+from calendar_gateway import CalendarGateway
+from governor import CalendarUnavailable
+from schedule import Schedule
+from workshops import Workshop
+
+
+def make_workshop(calendar, queue_dir):
+  schedule = Schedule.from_grid(main.start_times, main.end_times, main.locations)
+  return Workshop('test', 'Test', 'test', schedule, CalendarGateway(lambda: calendar, 'test'),
+                  os.path.join(queue_dir, 'bookings.sqlite3'))
+
+
+async def queue_booking(workshop, day, location, first, last):
+  body = main.booking_event(workshop, day, first, last, location, '3SG Test', 'Works', 1)
+  await workshop.booking_queue.enqueue({
+    'id': body['id'], 'chat_id': 1, 'day': day, 'location': location, 'starting_period': first,
+    'ending_period': last, 'name': '3SG Test', 'course': 'Works', 'body': body,
+  })
+  return body
+
+
+def test_enqueue_holds_slot_and_survives_restart(tmp_path):
+  calendar = FakeCalendar(latency = 0)
+  day = date.today() + timedelta(days = 1)
+
+  async def enqueue():
+    workshop = make_workshop(calendar, tmp_path)
+    workshop.booking_queue.open(on_result = None)
+    await queue_booking(workshop, day, 1, 0, 1)
+    assert not workshop.slot_index.is_free(day, 1, 1, 1)
+    workshop.booking_queue.close()
+    workshop.gateway.shutdown()
+
+  asyncio.run(enqueue())
+
+  # A new process holds the slot again from the log
+  workshop = make_workshop(calendar, tmp_path)
+  workshop.booking_queue.open(on_result = None)
+  assert workshop.booking_queue.pending_count() == 1
+  assert not workshop.slot_index.is_free(day, 1, 1, 1)
+  workshop.booking_queue.close()
+  workshop.gateway.shutdown()
+
+
+def test_flush_after_failed_verify_books_own_event(tmp_path):
+  # The insert reaches the calendar but the verify sync after it fails; the next flush must not call it a conflict
+  calendar = FakeCalendar(latency = 0)
+  results = []
+
+  async def on_result(booking, status, event):
+    results.append(status)
+
+  async def flush_twice():
+    workshop = make_workshop(calendar, tmp_path)
+    queue = workshop.booking_queue
+    queue.open(on_result)
+    body = await queue_booking(workshop, date.today() + timedelta(days = 1), 1, 0, 1)
+
+    refresh = workshop.event_cache.refresh
+    syncs = itertools.count(1)
+
+    async def failing_refresh():
+      if next(syncs) == 2:
+        raise CalendarUnavailable('verify sync failed')
+      await refresh()
+
+    workshop.event_cache.refresh = failing_refresh
+    await queue.flush()
+    assert results == []
+    await queue.flush()
+    queue.close()
+    workshop.gateway.shutdown()
+    return body
+
+  body = asyncio.run(flush_twice())
+  assert results == ['booked']
+  assert calendar._events[body['id']]['status'] == 'confirmed'
+  assert len([event for event in calendar._events.values() if event['status'] == 'confirmed']) == 1
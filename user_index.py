@@ -0,0 +1,54 @@
+# Private extended property holding the Telegram ID of the user who made a booking
+USER_PROPERTY = 'telegramUserId'
+
+
+def booking_owner(event):
+  """Telegram user ID a booking was made by, or None for events not made through the bot."""
+  owner = event.get('extendedProperties', {}).get('private', {}).get(USER_PROPERTY)
+  return int(owner) if owner and owner.isdigit() else None
+
+
+class UserIndex:
+  """Booking IDs per Telegram user, with their start times.
+
+  Bookings are tagged with the user's ID in a private extended property. The
+  index listens to the EventCache, so looking up a user's bookings never
+  scans the calendar.
+  """
+
+  def __init__(self):
+    self._by_user = {}
+    self._owners = {}
+
+  # EventCache listener interface
+  def event_added(self, event, start, end):
+    owner = booking_owner(event)
+    if owner is None:
+      return
+    self._by_user.setdefault(owner, {})[event['id']] = start
+    self._owners[event['id']] = owner
+
+  def event_removed(self, event_id):
+    owner = self._owners.pop(event_id, None)
+    if owner is None:
+      return
+    bookings = self._by_user[owner]
+    del bookings[event_id]
+    if not bookings:
+      del self._by_user[owner]
+
+  def cleared(self):
+    self._by_user.clear()
+    self._owners.clear()
+
+  # Queries
+  def owner(self, event_id):
+    return self._owners.get(event_id)
+
+  def bookings(self, user_id, after = None):
+    """IDs of a user's bookings starting after `after` (all if None), earliest first."""
+    bookings = self._by_user.get(user_id, {})
+    return sorted(
+      (event_id for event_id, start in bookings.items() if after is None or start > after),
+      key = bookings.get,
+    )
@@ -0,0 +1,110 @@
+import hmac
+import json
+
+from telegram import Update
+
+
+class WebhookApp:
+  """Minimal ASGI app that feeds Telegram webhook calls into the Application.
+
+  POST <path> accepts updates carrying the expected secret token header.
+  GET /health reports whether the bot is running, for the load balancer.
+  GET /metrics serves the bot's metrics in Prometheus text format.
+
+  With `answer_callbacks`, callback queries are answered in the webhook
+  response itself: Telegram stops the button's spinner at once and the bot
+  makes no request for it.
+  """
+
+  def __init__(self, application, path, secret_token, metrics = None, answer_callbacks = False):
+    self.application = application
+    self.path = path
+    self.secret_token = secret_token.encode()
+    self.metrics = metrics
+    self.answer_callbacks = answer_callbacks
+
+  async def __call__(self, scope, receive, send):
+    if scope['type'] != 'http':
+      return
+
+    if scope['path'] == '/health' and scope['method'] == 'GET':
+      running = self.application.running
+      await self._respond(send, 200 if running else 503, {'status': 'ok' if running else 'starting'})
+
+    elif scope['path'] == '/metrics' and scope['method'] == 'GET' and self.metrics is not None:
+      await self._send(send, 200, b'text/plain; version=0.0.4', self.metrics.render().encode())
+
+    elif scope['path'] == self.path and scope['method'] == 'POST':
+      headers = dict(scope['headers'])
+      token = headers.get(b'x-telegram-bot-api-secret-token', b'')
+      if not hmac.compare_digest(token, self.secret_token):
+        await self._respond(send, 403, {'error': 'forbidden'})
+        return
+
+      body = await self._read_body(receive)
+      try:
+        update = Update.de_json(json.loads(body), self.application.bot)
+      except (ValueError, KeyError, TypeError):
+        await self._respond(send, 400, {'error': 'invalid update'})
+        return
+
+      await self.application.update_queue.put(update)
+      if self.answer_callbacks and update.callback_query:
+        await self._respond(send, 200, {'method': 'answerCallbackQuery', 'callback_query_id': update.callback_query.id})
+      else:
+        await self._respond(send, 200, {'ok': True})
+
+    else:
+      await self._respond(send, 404, {'error': 'not found'})
+
+  @staticmethod
+  async def _read_body(receive):
+    body = b''
+    while True:
+      message = await receive()
+      body += message.get('body', b'')
+      if not message.get('more_body'):
+        return body
+
+  @classmethod
+  async def _respond(cls, send, status, payload):
+    await cls._send(send, status, b'application/json', json.dumps(payload).encode())
+
+  @staticmethod
+  async def _send(send, status, content_type, body):
+    await send({
+      'type': 'http.response.start',
+      'status': status,
+      'headers': [(b'content-type', content_type), (b'content-length', str(len(body)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def run_webhook(application, url, path, secret_token, host, port, metrics = None, answer_callbacks = False):
+  """Serve updates pushed by Telegram instead of polling for them."""
+  # Only webhook deployments need the HTTP server; polling workers never load it
+  import uvicorn
+
+  server = uvicorn.Server(uvicorn.Config(
+    WebhookApp(application, path, secret_token, metrics, answer_callbacks),
+    host = host,
+    port = port,
+    lifespan = 'off',
+    use_colors = False,
+  ))
+
+  async with application:
+    # run_polling/run_webhook call these hooks themselves; a custom server has to
+    if application.post_init:
+      await application.post_init(application)
+    await application.bot.set_webhook(url = url + path, secret_token = secret_token, allowed_updates = Update.ALL_TYPES)
+    await application.start()
+    try:
+      await server.serve()
+    finally:
+      await application.stop()
+      if application.post_stop:
+        await application.post_stop(application)
+
+  if application.post_shutdown:
+    await application.post_shutdown(application)
@@ -0,0 +1,138 @@
+import json
+import logging
+import os
+
+from booking_queue import BookingQueue
+from calendar_gateway import CALENDAR_WORKERS, CalendarGateway
+from event_cache import EventCache
+from governor import CALENDAR_BURST, CALENDAR_RATE, RequestGovernor, TokenBucket
+from reminders import ReminderScheduler
+from reservations import ReservationLayer
+from schedule import Schedule, load_schedule
+from slot_index import SlotIndex
+from user_index import UserIndex
+
+logger = logging.getLogger(__name__)
+
+WORKSHOPS_FILE = 'workshops.json'
+# Cancel buttons carry '<workshop ID>:<event ID>' in Telegram's 64-byte callback data, and event IDs made by the bot are 32 characters
+MAX_WORKSHOP_ID_BYTES = 64 - 1 - 32
+
+
+class Workshop:
+  """One workshop: its calendar and schedule (period grid and locations).
+
+  Every workshop has its own gateway (thread pool and request governor),
+  event cache, indexes, reservations and booking queue, so a busy
+  workshop only spends its own Calendar quota and never blocks another.
+  A schedule read from a file is reloaded when the file changes.
+  """
+
+  def __init__(self, workshop_id, name, calendar_id, schedule, gateway, queue_file, schedule_file = None):
+    self.id = workshop_id
+    self.name = name
+    self.calendar_id = calendar_id
+    self.schedule = schedule
+    self.schedule_file = schedule_file
+    self._schedule_mtime = schedule.version
+
+    self.gateway = gateway
+    self.event_cache = EventCache(gateway)
+    self.slot_index = SlotIndex(schedule)
+    self.user_index = UserIndex()
+    self.reminders = ReminderScheduler()
+    for listener in (self.slot_index, self.user_index, self.reminders):
+      self.event_cache.subscribe(listener)
+    self.reservations = ReservationLayer(gateway, self.event_cache, self.slot_index)
+    self.booking_queue = BookingQueue(queue_file, self.slot_index, self.reservations)
+
+  def __repr__(self):
+    return f'Workshop({self.id!r})'
+
+  # The grid of the current schedule
+  @property
+  def start_times(self):
+    return self.schedule.start_times
+
+  @property
+  def end_times(self):
+    return self.schedule.end_times
+
+  @property
+  def locations(self):
+    return self.schedule.locations
+
+  @property
+  def bookable_locations(self):
+    return self.schedule.bookable_locations
+
+  def reload_schedule(self):
+    """Load the schedule file again if it changed since it was last read. Returns True if the schedule changed.
+
+    A file that cannot be used is logged once and the current schedule is
+    kept. The slot index is rebuilt from the event cache; holds for queued
+    bookings are placed again on the new grid.
+    """
+    if not self.schedule_file:
+      return False
+    try:
+      mtime = os.stat(self.schedule_file).st_mtime_ns
+    except FileNotFoundError:
+      return False
+    if mtime == self._schedule_mtime:
+      return False
+    self._schedule_mtime = mtime
+
+    try:
+      schedule = load_schedule(self.schedule_file)
+    except (OSError, ValueError) as error:
+      logger.error('Keeping the current schedule of %s; could not load %s: %s', self.id, self.schedule_file, error)
+      return False
+    self.schedule = schedule
+    self.slot_index.set_schedule(schedule)
+    self.event_cache.replay(self.slot_index)
+    logger.info('Reloaded the schedule of %s from %s: %s.', self.id, self.schedule_file, schedule)
+    return True
+
+
+def load_workshops(path, service_factory, http_factory, default):
+  """Build every workshop in the registry file, keyed by ID and in file order.
+
+  Without a registry file the bot serves the single workshop described by
+  `default` (the CalendarID environment variable and the built-in grid).
+  Each entry needs `id`, `calendar_id` and either `schedule`, the path of a
+  schedule file, or an inline grid in `locations`, `start_times` and
+  `end_times`. When both are given the grid is used until the file exists.
+  `name`, `queue_file`, `calendar_rate`, `calendar_burst` and
+  `calendar_workers` are optional.
+  """
+  if os.path.exists(path):
+    with open(path) as registry:
+      entries = json.load(registry)['workshops']
+    logger.info('Loaded %s workshops from %s.', len(entries), path)
+  else:
+    entries = [default]
+
+  workshops = {}
+  for entry in entries:
+    # Workshop IDs go into callback data, which is split on ':' and limited in length
+    if ':' in entry['id']:
+      raise ValueError(f"Workshop {entry['id']}: IDs cannot contain ':'")
+    if len(entry['id'].encode()) > MAX_WORKSHOP_ID_BYTES:
+      raise ValueError(f"Workshop {entry['id']}: IDs can be at most {MAX_WORKSHOP_ID_BYTES} bytes long")
+    schedule_file = entry.get('schedule')
+    if schedule_file and os.path.exists(schedule_file):
+      schedule = load_schedule(schedule_file)
+    elif 'start_times' in entry:
+      schedule = Schedule.from_grid(entry['start_times'], entry['end_times'], entry['locations'])
+    else:
+      raise ValueError(f"Workshop {entry['id']}: no schedule file or grid")
+    governor = RequestGovernor(TokenBucket(
+      float(entry.get('calendar_rate', CALENDAR_RATE)), float(entry.get('calendar_burst', CALENDAR_BURST))))
+    gateway = CalendarGateway(service_factory, entry['calendar_id'], http_factory = http_factory,
+                              max_workers = int(entry.get('calendar_workers', CALENDAR_WORKERS)), governor = governor)
+    workshops[entry['id']] = Workshop(
+      entry['id'], entry.get('name', entry['id']), entry['calendar_id'], schedule, gateway,
+      entry.get('queue_file', f"bookings-{entry['id']}.sqlite3"), schedule_file,
+    )
+  return workshops